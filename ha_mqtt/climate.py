@@ -1,6 +1,8 @@
+import asyncio
+
 from ha_mqtt.ha import _Base
 from ha_mqtt.mqtt import MqttTopic
-from ha_mqtt.util import create_id
+from ha_mqtt.util import create_id, run_after, create_coalescer
 
 
 def default_state_change_func(mode, target):
@@ -25,6 +27,7 @@ class Climate(_Base):
             temp_step=1,
             temp_formatter_func=temp_formatter,
             state_topic=None,
+            command_coalesce_window=None,
             **kwargs):
         super().__init__(component_id=create_id(climate_id, climate_name), component_name=climate_name,
                          component_type='climate',
@@ -33,11 +36,14 @@ class Climate(_Base):
         assert state_change_func is not None, 'state_change_func cannot be None'
         assert thermometer is not None, 'thermometer cannot be None'
         assert heat is not None or cool is not None, 'heat and cool cannot both be None'
+        self._assert_dispatchable(state_change_func, 'state_change_func')
 
         self._state_change_func = state_change_func
         self._mode = 'off'
-        self._target = thermometer()
         self._thermometer = thermometer
+        self._thermometer_async = asyncio.iscoroutinefunction(thermometer)
+        self._temp = None
+        self._target = temp_min if self._thermometer_async else thermometer()
         self._temp_formatter_func = temp_formatter_func
 
         modes = ['off']
@@ -72,22 +78,25 @@ class Climate(_Base):
             self._topic_state_mode = state_topic
             self._topic_state_curr_temp = state_topic
             self._topic_state_target_temp = state_topic
+            mode_topic, mode_template = state_topic.add_topic_entry(self._component_id + '_mode',
+                                                                    lambda: self._mode)
+            curr_temp_topic, curr_temp_template = state_topic.add_topic_entry(
+                self._component_id + '_curr_temp', lambda: self._temp_get_and_format(stale_ok=True))
+            target_temp_topic, target_temp_template = state_topic.add_topic_entry(
+                self._component_id + '_target_temp', lambda: self._temp_formatter_func(self._target))
             self._add_to_config({
-                'mode_state_topic': self._topic_state_mode.name(),
-                'mode_state_template': self._topic_state_mode.add_entry(self._component_id + '_mode',
-                                                                        lambda: self._mode),
-                'current_temperature_topic': self._topic_state_curr_temp.name(),
-                'current_temperature_template': self._topic_state_curr_temp.add_entry(self._component_id + '_curr_temp',
-                                                                                      lambda: self._temp_formatter_func(
-                                                                                          self._thermometer())),
-                'temperature_state_topic': self._topic_state_mode.name(),
-                'temperature_state_template': self._topic_state_mode.add_entry(self._component_id + '_target_temp',
-                                                                               lambda: self._temp_formatter_func(
-                                                                                   self._target))
+                'mode_state_topic': mode_topic,
+                'mode_state_template': mode_template,
+                'current_temperature_topic': curr_temp_topic,
+                'current_temperature_template': curr_temp_template,
+                'temperature_state_topic': target_temp_topic,
+                'temperature_state_template': target_temp_template
             })
 
-        topic_command_mode.subscribe(lambda new_mode: self.set_mode(new_mode))
-        topic_command_target_temp.subscribe(lambda target: self.set_target(target))
+        set_mode = create_coalescer(self.set_mode, command_coalesce_window)
+        set_target = create_coalescer(self.set_target, command_coalesce_window)
+        topic_command_mode.subscribe(lambda new_mode: set_mode(new_mode), self.topic_filter('cmdMode'))
+        topic_command_target_temp.subscribe(lambda target: set_target(target), self.topic_filter('cmdTargetTemp'))
 
     def is_on(self):
         return self._mode != 'off'
@@ -105,15 +114,35 @@ class Climate(_Base):
             self._topic_state_target_temp.publish(self._temp_formatter_func(self._target))
             self._handle_state_change()
 
+    def _temp_get(self, stale_ok=False):
+        if self._thermometer_async:
+            return self._temp
+        return self._evaluate(self._thermometer, stale_ok)
+
+    def _temp_get_and_format(self, stale_ok=False):
+        temp = self._temp_get(stale_ok)
+        if temp is None:
+            return None  # Async thermometer has not been awaited yet
+        return self._temp_formatter_func(temp)
+
     def send_update(self, all_topics=False):
-        self._topic_state_curr_temp.publish(self._temp_formatter_func(self._thermometer()))
+        temp = self._temp_get_and_format()
+        if temp is not None:
+            self._topic_state_curr_temp.publish(temp)
         if all_topics:
             self._topic_state_mode.publish(self._mode)
             self._topic_state_target_temp.publish(self._temp_formatter_func(self._target))
 
+    def send_current_state(self):
+        self.send_update(all_topics=True)
+
+    async def send_update_async(self, all_topics=False):
+        if self._thermometer_async:
+            self._temp = await self._thermometer()
+        self.send_update(all_topics)
+
     def _handle_state_change(self):
-        self._state_change_func(self._mode, self._target)
-        self.send_update()
+        return run_after(self._state_change_func(self._mode, self._target), self.send_update)
 
     def __len__(self):
         return 29175  # Duck typing
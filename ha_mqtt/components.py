@@ -1,8 +1,19 @@
 import datetime
+import logging
+import math
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from ha_mqtt.mqtt import Mqtt
-from ha_mqtt.sensor import Sensor, SettableSensor
-from ha_mqtt.util import env
+from ha_mqtt.sensor import Sensor, SettableSensor, state_formatter_func_no_decimals
+from ha_mqtt.util import env, RingBuffer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def create_average_sensor(sensor_name, unit_of_measurement, sensors, **kwargs):
@@ -57,6 +68,185 @@ def create_weighted_average_sensor(sensor_name, unit_of_measurement, min_weight,
     return Sensor(sensor_name, unit_of_measurement, state_func=_sensor, **k), [w for t, w in pairs]
 
 
+def create_aggregate_sensor(sensor_name, unit_of_measurement, sensors, aggregate='mean', weights=None, **kwargs):
+    aggregator = _Aggregator(sensors, aggregate, weights)
+    return Sensor(sensor_name, unit_of_measurement, state_func=aggregator, **kwargs)
+
+
+class _Aggregator:
+    _AGGREGATES = ['sum', 'mean', 'weighted_mean', 'min', 'max']
+    _RESUM_INTERVAL = 1024  # Recompute the running sums now and then so float errors do not add up
+
+    def __init__(self, sensors, aggregate, weights):
+        assert aggregate in self._AGGREGATES, aggregate + ' is not a supported aggregate'
+        assert (weights is not None) == (aggregate == 'weighted_mean'), 'weights are required by weighted_mean only'
+        assert weights is None or len(weights) == len(sensors), 'there must be one weight per sensor'
+
+        self._sensors = sensors
+        self._weight_sensors = weights
+        self._aggregate = aggregate
+        self._lock = threading.Lock()
+        self._values = [None] * len(sensors)
+        self._weights = [0.0] * len(sensors)
+        self._primed = False
+        self._updates = 0
+        self._resum()
+
+        for i, s in enumerate(sensors):
+            s.add_state_listener(lambda _, value, i=i: self._set_value(i, value))
+        for i, w in enumerate(weights or []):
+            w.add_state_listener(lambda _, weight, i=i: self._set_weight(i, weight))
+
+    def _resum(self):
+        values = [v for v in self._values if v is not None]
+        self._count = len(values)
+        self._sum = float(sum(values))
+        self._weighted_sum = float(sum(v * w for v, w in zip(self._values, self._weights) if v is not None))
+        self._sum_weights = float(sum(w for v, w in zip(self._values, self._weights) if v is not None))
+        self._min = min(values) if len(values) > 0 else None
+        self._max = max(values) if len(values) > 0 else None
+        self._updates = 0
+
+    def _set_value(self, i, value):
+        with self._lock:
+            old = self._values[i]
+            self._values[i] = value
+            if old is not None:
+                self._count = self._count - 1
+                self._sum = self._sum - old
+                self._weighted_sum = self._weighted_sum - old * self._weights[i]
+                self._sum_weights = self._sum_weights - self._weights[i]
+            if value is not None:
+                self._count = self._count + 1
+                self._sum = self._sum + value
+                self._weighted_sum = self._weighted_sum + value * self._weights[i]
+                self._sum_weights = self._sum_weights + self._weights[i]
+            self._updates = self._updates + 1
+
+            if self._updates >= self._RESUM_INTERVAL or \
+                    (old is not None and (old == self._min or old == self._max)):
+                self._resum()  # The old extreme is gone, only now do we need to look at every value
+            elif value is not None:
+                self._min = value if self._min is None else min(self._min, value)
+                self._max = value if self._max is None else max(self._max, value)
+
+    def _set_weight(self, i, weight):
+        weight = weight if weight is not None else 0.0
+        with self._lock:
+            old = self._weights[i]
+            self._weights[i] = weight
+            if self._values[i] is not None:
+                self._weighted_sum = self._weighted_sum + self._values[i] * (weight - old)
+                self._sum_weights = self._sum_weights + weight - old
+
+    def _prime(self):
+        # Inputs that have not been read yet are read once, after that only their listeners update us
+        for i, s in enumerate(self._sensors):
+            if self._values[i] is None:
+                self._set_value(i, s())
+        for i, w in enumerate(self._weight_sensors or []):
+            self._set_weight(i, w())
+        self._primed = True
+
+    def __call__(self):
+        if not self._primed:
+            self._prime()
+        with self._lock:
+            if self._aggregate == 'sum':
+                return self._sum
+            if self._aggregate == 'min':
+                return self._min
+            if self._aggregate == 'max':
+                return self._max
+            if self._count == 0:
+                return 0.0
+            if self._aggregate == 'weighted_mean' and self._sum_weights != 0:
+                return self._weighted_sum / self._sum_weights
+            return self._sum / self._count
+
+
+def create_window_sensor(sensor_name, unit_of_measurement, source, window=60, stat='mean', percentile=None, **kwargs):
+    return Sensor(sensor_name, unit_of_measurement, state_func=_WindowStatistic(source, window, stat, percentile),
+                  **kwargs)
+
+
+class _WindowStatistic:
+    _STATS = ['mean', 'sum', 'min', 'max', 'stddev', 'median', 'percentile']
+    _RESUM_INTERVAL = 1024  # Recompute the running sums now and then so float errors do not add up
+
+    def __init__(self, source, window, stat, percentile):
+        assert source is not None, 'source cannot be None'
+        assert stat in self._STATS, stat + ' is not a supported statistic'
+        assert stat != 'percentile' or (percentile is not None and 0 <= percentile <= 100), \
+            'percentile must be between 0 and 100'
+
+        self._source = source
+        self._stat = stat
+        self._percentile = 50 if stat == 'median' else percentile
+        self._lock = threading.Lock()
+        self._samples = RingBuffer(window)
+        self._count = 0
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self._min = deque()  # Monotonic deques of (sample number, value)
+        self._max = deque()
+
+    def _add(self, value):
+        evicted = self._samples.append(value)
+        self._count = self._count + 1
+        self._sum = self._sum + value
+        self._sum_squares = self._sum_squares + value * value
+        if evicted is not None:
+            self._sum = self._sum - evicted
+            self._sum_squares = self._sum_squares - evicted * evicted
+        if self._count % self._RESUM_INTERVAL == 0:
+            values = self._samples.values()
+            self._sum = math.fsum(values)
+            self._sum_squares = math.fsum(v * v for v in values)
+
+        oldest = self._count - len(self._samples)
+        for extremes, keep in [(self._min, lambda v: v < value), (self._max, lambda v: v > value)]:
+            while len(extremes) > 0 and not keep(extremes[-1][1]):
+                extremes.pop()
+            extremes.append((self._count, value))
+            while extremes[0][0] <= oldest:
+                extremes.popleft()
+
+    def _compute(self):
+        n = len(self._samples)
+        if n == 0:
+            return None
+        if self._stat == 'mean':
+            return self._sum / n
+        if self._stat == 'sum':
+            return self._sum
+        if self._stat == 'min':
+            return self._min[0][1]
+        if self._stat == 'max':
+            return self._max[0][1]
+        if self._stat == 'stddev':
+            mean = self._sum / n
+            return math.sqrt(max(0.0, self._sum_squares / n - mean * mean))
+        return _percentile(self._samples.values(), self._percentile)
+
+    def __call__(self):
+        value = self._source()
+        with self._lock:
+            if value is not None:
+                self._add(float(value))
+            return self._compute()
+
+
+def _percentile(values, percentile):
+    if numpy is not None:
+        return float(numpy.percentile(numpy.frombuffer(values, dtype=numpy.float64), percentile))
+    values = sorted(values)
+    rank = (len(values) - 1) * percentile / 100
+    low = int(math.floor(rank))
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
 def create_last_update_sensor(sensor_name, **kwargs):
     def _sensor():
         return datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat()
@@ -66,6 +256,14 @@ def create_last_update_sensor(sensor_name, **kwargs):
                   **kwargs)
 
 
+def create_circuit_breaker_sensors(sensor_name, circuit_breaker, **kwargs):
+    state = Sensor(sensor_name + ' state', '', state_func=circuit_breaker.get_state, icon='mdi:electric-switch',
+                   state_formatter_func=lambda s: s, **kwargs)
+    trips = Sensor(sensor_name + ' trips', 'trips', state_func=circuit_breaker.get_trips, icon='mdi:alarm-light',
+                   state_formatter_func=state_formatter_func_no_decimals, **kwargs)
+    return [state, trips]
+
+
 def create_func_result_cache(func):
     old = [None]
 
@@ -82,24 +280,105 @@ def create_func_call_limiter():
     return _FuncCallLimiter()
 
 
-class _FuncCallLimiter:
-    def __init__(self):
-        self._funcs = {}
+def create_ttl_cache(max_size=None, workers=1):
+    return _TtlCache(max_size, workers)
 
-    def wrap(self, f):
-        self._funcs[f] = None
 
-        def _w():
-            if self._funcs[f] is None:
-                self._funcs[f] = f()
-            return self._funcs[f]
+class _CacheEntry:
+    def __init__(self, value, updated):
+        self.value = value
+        self.updated = updated
+        self.refreshing = False
+
+
+class _TtlCache:
+    def __init__(self, max_size=None, workers=1):
+        assert max_size is None or max_size > 0, 'max_size must be positive'
+        assert workers > 0, 'workers must be positive'
+
+        self._max_size = max_size
+        self._workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # Least recently used first
+        self._stats = {'hits': 0, 'misses': 0, 'stale_hits': 0, 'refreshes': 0, 'refresh_errors': 0, 'evictions': 0}
+
+    def wrap(self, f, ttl=None, stale_while_revalidate=True):
+        assert ttl is None or ttl >= 0, 'ttl cannot be negative'
+
+        def _w(*args):
+            return self._get((f, args), lambda: f(*args), ttl, stale_while_revalidate)
 
         return _w
 
+    def _get(self, key, load, ttl, stale_while_revalidate):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if ttl is None or now - entry.updated < ttl:
+                    self._stats['hits'] = self._stats['hits'] + 1
+                    return entry.value
+                if stale_while_revalidate:
+                    # Serve the stale value right away and let a worker fetch a fresh one
+                    self._stats['stale_hits'] = self._stats['stale_hits'] + 1
+                    if not entry.refreshing:
+                        entry.refreshing = True
+                        self._submit(key, load)
+                    return entry.value
+            self._stats['misses'] = self._stats['misses'] + 1
+
+        value = load()
+        self._store(key, value)
+        return value
+
+    def _submit(self, key, load):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        self._executor.submit(self._refresh, key, load)
+
+    def _refresh(self, key, load):
+        try:
+            value = load()
+        except:
+            logging.error('Error refreshing cached value', exc_info=True)
+            with self._lock:
+                self._stats['refresh_errors'] = self._stats['refresh_errors'] + 1
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refreshing = False
+            return
+        with self._lock:
+            self._stats['refreshes'] = self._stats['refreshes'] + 1
+        self._store(key, value)
+
+    def _store(self, key, value):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = _CacheEntry(value, time.monotonic())
+            else:
+                entry.value = value
+                entry.updated = time.monotonic()
+                entry.refreshing = False
+                self._entries.move_to_end(key)
+            while self._max_size is not None and len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] = self._stats['evictions'] + 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._entries))
+
     def clear(self):
-        for f in self._funcs:
-            self._funcs[f] = None
-        return
+        with self._lock:
+            self._entries.clear()
+
+
+class _FuncCallLimiter(_TtlCache):
+    def wrap(self, f, ttl=None, stale_while_revalidate=False):
+        return super().wrap(f, ttl, stale_while_revalidate)
 
 
 def create_mqtt(mqtt_host=env('MQTT_HOST', 'homeassistant.local'), mqtt_username=env('MQTT_USER'),
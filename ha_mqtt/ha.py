@@ -1,6 +1,12 @@
+import asyncio
+import contextvars
+import hashlib
+import itertools
+import json
 import logging
+import threading
 
-from ha_mqtt.mqtt import MqttTopic
+from ha_mqtt.mqtt import MqttTopic, JsonMessage
 
 DISCOVERY_PREFIX = 'homeassistant'
 
@@ -20,6 +26,33 @@ ALLOWED_COMPONENT_TYPES = [
 ]
 
 
+# Abbreviations Home Assistant accepts in discovery payloads, keys without one are sent as is
+DISCOVERY_ABBREVIATIONS = {
+    'availability_topic': 'avty_t',
+    'command_topic': 'cmd_t',
+    'current_temperature_template': 'curr_temp_tpl',
+    'current_temperature_topic': 'curr_temp_t',
+    'device_class': 'dev_cla',
+    'icon': 'ic',
+    'mode_command_topic': 'mode_cmd_t',
+    'mode_state_template': 'mode_stat_tpl',
+    'mode_state_topic': 'mode_stat_t',
+    'payload_available': 'pl_avail',
+    'payload_not_available': 'pl_not_avail',
+    'payload_off': 'pl_off',
+    'payload_on': 'pl_on',
+    'state_off': 'stat_off',
+    'state_on': 'stat_on',
+    'state_topic': 'stat_t',
+    'temperature_command_topic': 'temp_cmd_t',
+    'temperature_state_template': 'temp_stat_tpl',
+    'temperature_state_topic': 'temp_stat_t',
+    'unique_id': 'uniq_id',
+    'unit_of_measurement': 'unit_of_meas',
+    'value_template': 'val_tpl',
+}
+
+
 def _create_topic_name(component_type=None, node_id=None, component_id=None):
     assert component_type in ALLOWED_COMPONENT_TYPES, component_type + " is not allowed"
     assert component_id is not None, "component id cannot be None"
@@ -31,6 +64,29 @@ def _create_topic_name(component_type=None, node_id=None, component_id=None):
     )
 
 
+def config_hash(config):
+    # Key order and whitespace depend on the serializer, so configs are compared in a canonical form
+    return hashlib.sha1(json.dumps(config, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class EvaluationContext:
+    def __init__(self):
+        # The epoch is only visible to the update cycle that opened it and the tasks it spawns, so commands
+        # handled on other threads or callbacks during a cycle never read a memoized value
+        self._epochs = itertools.count(1)
+        self._current = contextvars.ContextVar('evaluation_epoch', default=None)
+
+    def open(self):
+        # Cycles may overlap, so each one keeps its own token instead of sharing one on the context
+        return self._current.set(next(self._epochs))
+
+    def close(self, token):
+        self._current.reset(token)
+
+    def current(self):
+        return self._current.get()
+
+
 class Ha:
 
     def __init__(
@@ -40,15 +96,24 @@ class Ha:
             node_id=None,
             component_id=None,
             auto_discovery=True,
+            collapse_subscriptions=True,
+            retain_discovery=False,
+            compact_discovery=False,
     ):
         assert mqtt is not None, "mqtt cannot be None"
 
         self._mqtt = mqtt
         self._config = {}
+        self._config_message = None
         self._component_type = component_type
         self._node_id = node_id
         self._component_id = component_id
         self._auto_discovery = auto_discovery
+        self._collapse_subscriptions = collapse_subscriptions
+        self._discovery_info = None
+        self._retain_discovery = retain_discovery
+        self._retained_hash = None
+        self._compact_discovery = compact_discovery
         self._add_to_config({
             'unique_id': component_id
         })
@@ -59,22 +124,79 @@ class Ha:
     def publish(self, topic, message):
         self._mqtt.publish(topic, message)
 
+    def is_discovered(self):
+        return self._discovery_info is None or self._discovery_info.is_published()
+
     def topic_name(self, name):
         return _create_topic_name(component_type=self._component_type, node_id=self._node_id,
                                   component_id=self._component_id) + name
 
+    def get_node_id(self):
+        return self._node_id
+
+    def set_retain_discovery(self, retain_discovery):
+        self._retain_discovery = retain_discovery
+
+    def set_compact_discovery(self, compact_discovery):
+        self._compact_discovery = compact_discovery
+        self._config_message = None
+
+    def set_retained_config(self, payload):
+        try:
+            self._retained_hash = config_hash(json.loads(payload)) if payload else None
+        except ValueError:
+            self._retained_hash = None
+
+    def is_config_retained(self):
+        return self._retained_hash is not None and self._retained_hash == config_hash(self._discovery_config())
+
+    def topic_filter(self, name):
+        # Components on the same node share one broker subscription per command name
+        if self._node_id is None or not self._collapse_subscriptions:
+            return None
+        return '{}/+/{}/+/{}'.format(DISCOVERY_PREFIX, self._node_id, name)
+
     def _add_to_config(self, d):
         self._config.update(d)
+        self._config_message = None
+
+    def _discovery_config(self):
+        if not self._compact_discovery:
+            return self._config
+
+        # Topics under the component's own prefix are written relative to the '~' base topic
+        base = self.topic_name('')
+        config = {'~': base[:-1]}
+        for k, v in self._config.items():
+            if k.endswith('_topic') and isinstance(v, str) and v.startswith(base):
+                v = '~/' + v[len(base):]
+            config[DISCOVERY_ABBREVIATIONS.get(k, k)] = v
+        return config
+
+    def _discovery_message(self):
+        # The config is frozen once the component is constructed, so it is only serialized once
+        if self._config_message is None:
+            self._config_message = JsonMessage(self._discovery_config())
+        return self._config_message
+
+    def announce(self):
+        if self._auto_discovery:
+            self._discovery_info = self._mqtt.publish(self.topic_name('config'), self._discovery_message(), qos=1,
+                                                      retain=self._retain_discovery)
 
     def __enter__(self):
         if self._auto_discovery:
             assert self._config is not None, "component configuration cannot be none"
+            if self._retain_discovery and self.is_config_retained():
+                logging.debug('HASS component {}.{} is unchanged'.format(self._component_type, self._component_id))
+                return self
             logging.info('HASS adding component {}.{}'.format(self._component_type, self._component_id))
-            self._mqtt.publish(self.topic_name('config'), self._config)
+        self.announce()
         return self
 
     def __exit__(self, *args):
-        if self._auto_discovery:
+        # Retained configs outlive the process so the next start only has to publish what changed
+        if self._auto_discovery and not self._retain_discovery:
             logging.info('HASS removing component {}.{}'.format(self._component_type, self._component_id))
             self._mqtt.publish(self.topic_name('config'), None)
 
@@ -107,7 +229,13 @@ class _Base(Ha):
                 'device_class': device_class
             })
 
+        self._evaluation_context = None
+        self._evaluated_epoch = None
+        self._evaluated_value = None
+        self._evaluation_lock = threading.RLock()
+
         self._availability_topic = None
+        self._unavailable_holds = set()
         if availability_topic:
             self._availability_topic = MqttTopic(kwargs['mqtt'], self.topic_name('available'))
             self._add_to_config({
@@ -116,10 +244,45 @@ class _Base(Ha):
                 'payload_not_available': 'offline',
             })
 
+    def _assert_dispatchable(self, func, name):
+        # Commands arrive on paho's network thread unless the client runs on the event loop
+        assert not asyncio.iscoroutinefunction(func) or getattr(self._mqtt, 'dispatches_on_event_loop', False), \
+            name + ' is a coroutine function, which needs AsyncMqtt'
+
     def available_set(self, available):
         if self._availability_topic is not None:
+            available = available and len(self._unavailable_holds) == 0
             self._availability_topic.publish('online' if available else 'offline')
 
+    def hold_unavailable(self, holder, hold):
+        # While anyone holds it, e.g. an open circuit breaker, re-announcing cannot mark the component available
+        if hold:
+            self._unavailable_holds.add(holder)
+        else:
+            self._unavailable_holds.discard(holder)
+        self.available_set(not hold)
+
+    def is_unavailable_held(self):
+        return len(self._unavailable_holds) > 0
+
+    def set_evaluation_context(self, context):
+        self._evaluation_context = context
+
+    def _evaluate(self, func, stale_ok=False):
+        # Within an open epoch the value is computed once and shared by every reader
+        epoch = self._evaluation_context.current() if self._evaluation_context is not None else None
+        if epoch is None:
+            return func()
+        if not self._evaluation_lock.acquire(blocking=not stale_ok):
+            return self._evaluated_value  # Still being computed, e.g. by a timed out worker, so use the last value
+        try:
+            if self._evaluated_epoch != epoch:
+                self._evaluated_value = func()
+                self._evaluated_epoch = epoch
+            return self._evaluated_value
+        finally:
+            self._evaluation_lock.release()
+
     def get_id(self):
         return self._component_id
 
@@ -137,3 +300,10 @@ class _Base(Ha):
 
     def send_update(self):
         pass
+
+    def send_current_state(self):
+        # Used when re-announcing, where the state has to go out even if update filters would hold it back
+        self.send_update()
+
+    async def send_update_async(self):
+        self.send_update()
@@ -1,23 +1,204 @@
+import asyncio
 import json
 import logging
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from paho.mqtt.client import Client as Client
+from paho.mqtt.client import Client as Client, MQTT_ERR_SUCCESS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_serializer(message):
+    return json.dumps(message)
+
+
+def orjson_serializer(message):
+    return orjson.dumps(message)
+
+
+def default_serializer():
+    return orjson_serializer if orjson is not None else json_serializer
+
+
+class _TopicNode:
+    __slots__ = ('children', 'funcs')
+
+    def __init__(self, children=None, funcs=()):
+        self.children = children if children is not None else {}
+        self.funcs = funcs
+
+
+class TopicTrie:
+    def __init__(self):
+        self._root = _TopicNode()
+        self._lock = threading.Lock()
+
+    def add(self, topic_filter, func):
+        # Copy-on-write: readers keep using the root they started with, writers swap in a new one
+        with self._lock:
+            self._root, added = self._add(self._root, topic_filter.split('/'), func)
+        return added
+
+    def _add(self, node, levels, func):
+        if len(levels) == 0:
+            return _TopicNode(node.children, node.funcs + (func,)), len(node.funcs) == 0
+        child, added = self._add(node.children.get(levels[0], _TopicNode()), levels[1:], func)
+        children = dict(node.children)
+        children[levels[0]] = child
+        return _TopicNode(children, node.funcs), added
+
+    def remove(self, topic_filter, func):
+        with self._lock:
+            root, removed = self._remove(self._root, topic_filter.split('/'), func)
+            if root is not None:
+                self._root = root
+        return removed
+
+    def _remove(self, node, levels, func):
+        if len(levels) == 0:
+            if func not in node.funcs:
+                return None, False
+            funcs = tuple(f for f in node.funcs if f != func)  # Bound methods are equal, not identical
+            return _TopicNode(node.children, funcs), len(funcs) == 0
+        child = node.children.get(levels[0])
+        if child is None:
+            return None, False
+        child, removed = self._remove(child, levels[1:], func)
+        if child is None:
+            return None, False
+        children = dict(node.children)
+        if len(child.funcs) == 0 and len(child.children) == 0:
+            del children[levels[0]]
+        else:
+            children[levels[0]] = child
+        return _TopicNode(children, node.funcs), removed
+
+    def match(self, topic):
+        funcs = []
+        self._match(self._root, topic.split('/'), 0, topic.startswith('$'), funcs)
+        return funcs
+
+    def _match(self, node, levels, i, system_topic, funcs):
+        wildcards = not (i == 0 and system_topic)  # Wildcards never match a leading '$' level
+        if i == len(levels):
+            funcs.extend(node.funcs)
+            parent = node.children.get('#')  # 'a/#' also matches 'a'
+            if parent is not None:
+                funcs.extend(parent.funcs)
+            return
+        child = node.children.get(levels[i])
+        if child is not None:
+            self._match(child, levels, i + 1, system_topic, funcs)
+        if wildcards:
+            child = node.children.get('+')
+            if child is not None:
+                self._match(child, levels, i + 1, system_topic, funcs)
+            child = node.children.get('#')
+            if child is not None:
+                funcs.extend(child.funcs)
+
+    def filters(self):
+        res = []
+        self._filters(self._root, [], res)
+        return res
+
+    def _filters(self, node, levels, res):
+        if len(node.funcs) > 0:
+            res.append('/'.join(levels))
+        for level, child in node.children.items():
+            self._filters(child, levels + [level], res)
+
+
+class _TopicCallback:
+    # Wildcard subscribers that need to know which topic matched get it as the first argument
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, topic, payload):
+        self.func(topic, payload)
+
+    def __eq__(self, other):
+        return isinstance(other, _TopicCallback) and self.func == other.func
+
+    def __hash__(self):
+        return hash(self.func)
+
+
+class JsonMessage(dict):
+    encoded = None
+
+
+class _KeyedExecutor:
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args):
+        # Work for a key already being drained is queued behind it, keeping each key in order
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((func, args))
+                return
+            self._queues[key] = deque([(func, args)])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if len(queue) == 0:
+                    del self._queues[key]
+                    return
+                func, args = queue.popleft()
+            try:
+                func(*args)
+            except:
+                logging.error('Error in subscription callback', exc_info=True)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
 
 
 class Mqtt:
-    _mqtt_client = None
-    _mqtt_subs = {}
+    dispatches_on_event_loop = False  # Callbacks run on paho's network thread
 
     def __init__(
             self,
             mqtt_host=None,
             mqtt_username=None,
-            mqtt_password=None
+            mqtt_password=None,
+            publish_cache=False,
+            publish_cache_interval=None,
+            max_inflight_messages=None,
+            dispatch_workers=None,
+            serializer=None,
+            offline_queue=None,
+            client_id=None,
+            clean_session=None,
+            subscribe_qos=None
     ):
         assert mqtt_host is not None, 'host id cannot be None'
+        assert clean_session is not False or client_id, 'a persistent session needs a client_id'
+        assert dispatch_workers is None or dispatch_workers > 0, 'dispatch_workers must be positive'
+        assert publish_cache_interval is None or publish_cache_interval > 0, 'publish_cache_interval must be positive'
 
         self._host = mqtt_host
-        self._mqtt_client = Client()
+        self._serializer = serializer if serializer is not None else default_serializer()
+        # A persistent session lets the broker keep our subscriptions and queued messages across reconnects
+        self._clean_session = clean_session if clean_session is not None else not client_id
+        self._subscribe_qos = subscribe_qos if subscribe_qos is not None else (0 if self._clean_session else 1)
+        self._mqtt_client = Client(client_id=client_id or '', clean_session=self._clean_session)
         _mqtt_logger = logging.getLogger('mqtt.client')
         _mqtt_logger.setLevel(logging.WARN)
         self._mqtt_client.enable_logger(_mqtt_logger)
@@ -26,44 +207,209 @@ class Mqtt:
             logging.info('MQTT connecting with user and pass')
             self._mqtt_client.username_pw_set(mqtt_username, mqtt_password)
 
+        if max_inflight_messages is not None:
+            self._mqtt_client.max_inflight_messages_set(max_inflight_messages)
+
         self._mqtt_client.on_message = self._on_message
         self._mqtt_client.on_connect = self._on_connect
+        self._mqtt_client.on_disconnect = self._on_disconnect
         self._topics = {}
+        self._mqtt_subs = TopicTrie()
+        self._broker_subs = {}
+        self._broker_subs_lock = threading.Lock()
+        self._dispatch_workers = dispatch_workers
+        self._dispatcher = None
+
+        self._publish_cache = publish_cache
+        self._publish_cache_interval = publish_cache_interval
+        self._publish_cache_lock = threading.Lock()
+        self._last_published = {}
+        self._published_count = 0
+        self._suppressed_count = 0
+
+        self._connected = False
+        self._ever_connected = False
+        self._reconnect_listeners = []
+        self._offline_queue = offline_queue
+        self._replay_lock = threading.Lock()
+        self._replaying = False
 
     def _on_connect(self, client, userdata, flags, rc):
         if rc != 0:
             logging.error('MQTT failed to connect to {}: {}'.format(self._host, rc))
-            raise SystemExit
-        else:
-            logging.info('MQTT successfully connected to host {}'.format(self._host))
+            if not self._ever_connected:
+                raise SystemExit
+            return  # The client keeps retrying in the background
+        session_present = bool(flags.get('session present', 0))
+        reconnect = self._ever_connected
+        logging.info('MQTT successfully {} to host {} (session present: {})'.format(
+            'reconnected' if reconnect else 'connected', self._host, session_present))
+        self._connected = True
+        self._ever_connected = True
+        if not session_present:
+            self._resubscribe()
+        if reconnect:
+            self.clear_publish_cache()  # Anything published while disconnected may have been lost
+            for func in self._reconnect_listeners:
+                func(session_present)
+        self._start_replay()
+
+    def _resubscribe(self):
+        # All filters go out in a single SUBSCRIBE packet instead of one round trip each
+        with self._broker_subs_lock:
+            filters = [(f, self._subscribe_qos) for f in self._broker_subs]
+        if len(filters) > 0:
+            logging.info('MQTT resubscribing to {} filters'.format(len(filters)))
+            self._mqtt_client.subscribe(filters)
+
+    def add_reconnect_listener(self, func):
+        self._reconnect_listeners.append(func)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected = False
+        if rc != 0:
+            logging.warning('MQTT unexpectedly disconnected from host {}: {}'.format(self._host, rc))
+
+    def _start_replay(self):
+        if self._offline_queue is None:
+            return
+        with self._replay_lock:
+            if self._replaying or len(self._offline_queue) == 0:
+                return
+            self._replaying = True
+        threading.Thread(target=self._replay_loop, name='mqtt-replay', daemon=True).start()
+
+    def _replay_loop(self):
+        interval = 1.0 / self._offline_queue.get_replay_rate()
+        while self._replay_next():
+            time.sleep(interval)
+
+    def _replay_next(self):
+        # Sent under the lock, so a live publish of the same topic either drops this entry or goes out after it
+        with self._replay_lock:
+            item = self._offline_queue.pop() if self._connected else None
+            if item is None:
+                self._replaying = False
+                return False
+            topic, payload, qos, retain = item
+            r = self._mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+            if r.rc != 0:
+                logging.warning('MQTT replay failed on topic {}, keeping it queued'.format(topic))
+                self._offline_queue.put(topic, payload, qos, retain)
+                self._replaying = False
+                return False
+        logging.debug('MQTT msg replayed on topic {}: {}'.format(topic, payload))
+        return True
+
+    def _enqueue(self, topic, message, qos, retain):
+        # Before the first CONNACK paho buffers the traffic itself, only an outage is queued
+        with self._replay_lock:
+            if self._connected or not self._ever_connected:
+                self._offline_queue.discard(topic)  # The live value supersedes one still waiting for replay
+                return False
+            self._offline_queue.put(topic, message, qos, retain)
+        logging.debug('MQTT msg queued on topic {}: {}'.format(topic, message))
+        return True
 
     def _on_message(self, client, userdata, message):
         payload = str(message.payload.decode("utf-8"))
         logging.debug('MQTT msg received on topic {}: {}'.format(message.topic, payload))
-        sub_functions = self._mqtt_subs.get(message.topic, [])
-        for func in sub_functions:
-            func(payload)
-
-    def subscribe(self, topic, func):
-        logging.debug('MQTT subscribing to {}'.format(topic))
-        sub_functions = self._mqtt_subs.get(topic, [])
-        if len(sub_functions) == 0:
-            self._mqtt_client.subscribe(topic)
-        sub_functions.append(func)
-        self._mqtt_subs[topic] = sub_functions
-
-    def publish(self, topic, message):
-        if type(message) is dict:
-            message = json.dumps(message)
+        funcs = self._mqtt_subs.match(message.topic)
+        if self._dispatcher is None:
+            self._dispatch(funcs, message.topic, payload)
+        elif len(funcs) > 0:
+            # Commands for one entity share a key and stay in order, different entities run in parallel
+            self._dispatcher.submit(message.topic.rsplit('/', 1)[0], self._dispatch, funcs, message.topic, payload)
+
+    @staticmethod
+    def _dispatch(funcs, topic, payload):
+        for func in funcs:
+            if isinstance(func, _TopicCallback):
+                func(topic, payload)
+            else:
+                func(payload)
+
+    def subscribe(self, topic, func, broker_filter=None, with_topic=False):
+        # The broker filter may cover many local topics, in which case only the first subscribe reaches the broker
+        broker_filter = broker_filter if broker_filter is not None else topic
+        logging.debug('MQTT subscribing to {} through {}'.format(topic, broker_filter))
+        self._mqtt_subs.add(topic, _TopicCallback(func) if with_topic else func)
+        with self._broker_subs_lock:
+            count = self._broker_subs.get(broker_filter, 0)
+            self._broker_subs[broker_filter] = count + 1
+            if count == 0:
+                self._mqtt_client.subscribe(broker_filter, self._subscribe_qos)
+
+    def unsubscribe(self, topic, func, broker_filter=None, with_topic=False):
+        broker_filter = broker_filter if broker_filter is not None else topic
+        logging.debug('MQTT unsubscribing from {} through {}'.format(topic, broker_filter))
+        self._mqtt_subs.remove(topic, _TopicCallback(func) if with_topic else func)
+        with self._broker_subs_lock:
+            count = self._broker_subs.get(broker_filter, 0)
+            if count <= 1:
+                self._broker_subs.pop(broker_filter, None)
+                if count == 1:
+                    self._mqtt_client.unsubscribe(broker_filter)
+            else:
+                self._broker_subs[broker_filter] = count - 1
+
+    def publish(self, topic, message, qos=0, retain=False):
+        if hasattr(message, 'encoded'):  # Duck typing, JsonMessage
+            if message.encoded is None:
+                message.encoded = self._serializer(message)  # Reused on every later publish of the same message
+            message = message.encoded
+        elif isinstance(message, dict):
+            message = self._serializer(message)
         message = message if message is not None else ""
-        r = self._mqtt_client.publish(topic, message)
-        if r.rc != 0:
+        if self._publish_cache and self._is_unchanged(topic, message):
+            logging.debug('MQTT msg suppressed on topic {}: {}'.format(topic, message))
+            return None
+        if self._offline_queue is not None and self._enqueue(topic, message, qos, retain):
+            return None
+        r = self._mqtt_client.publish(topic, message, qos=qos, retain=retain)
+        if r.rc != 0 and self._offline_queue is not None:
+            logging.warning('MQTT msg failed to send on topic {}, queueing it: {}'.format(topic, message))
+            self._offline_queue.put(topic, message, qos, retain)
+        elif r.rc != 0:
             logging.warning('MQTT msg failed to send on topic {}: {}'.format(topic, message))
+            if self._publish_cache:
+                self.clear_publish_cache(topic)
         else:
+            self._published_count = self._published_count + 1
             logging.debug('MQTT msg sent on topic {}: {}'.format(topic, message))
+        return r
+
+    def _is_unchanged(self, topic, message):
+        now = time.monotonic()
+        with self._publish_cache_lock:
+            last = self._last_published.get(topic)
+            if last is not None and last[0] == message and (
+                    self._publish_cache_interval is None or now - last[1] < self._publish_cache_interval):
+                self._suppressed_count = self._suppressed_count + 1
+                return True
+            self._last_published[topic] = (message, now)
+            return False
+
+    def clear_publish_cache(self, topic=None):
+        with self._publish_cache_lock:
+            if topic is None:
+                self._last_published.clear()
+            else:
+                self._last_published.pop(topic, None)
+
+    def get_serializer(self):
+        return self._serializer
+
+    def get_published_count(self):
+        return self._published_count
+
+    def get_suppressed_count(self):
+        return self._suppressed_count
 
     def __enter__(self):
         logging.info('MQTT connecting to host {}'.format(self._host))
+        if self._dispatch_workers is not None:
+            self._dispatcher = _KeyedExecutor(self._dispatch_workers)
         self._mqtt_client.connect(self._host)
         self._mqtt_client.loop_start()
         return self
@@ -72,6 +418,173 @@ class Mqtt:
         logging.info('MQTT disconnecting from host {}'.format(self._host))
         self._mqtt_client.loop_stop()
         self._mqtt_client.disconnect()
+        if self._dispatcher is not None:
+            self._dispatcher.shutdown()
+            self._dispatcher = None
+
+
+class AsyncMqtt(Mqtt):
+    dispatches_on_event_loop = True
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 120
+
+    def __init__(self, **kwargs):
+        assert kwargs.get('dispatch_workers') is None, 'AsyncMqtt dispatches callbacks on the event loop'
+        super().__init__(**kwargs)
+        self._loop = None
+        self._misc_task = None
+        self._reconnect_task = None
+        self._closing = False
+        self._disconnected = None
+
+        self._mqtt_client.on_socket_open = self._on_socket_open
+        self._mqtt_client.on_socket_close = self._on_socket_close
+        self._mqtt_client.on_socket_register_write = self._on_socket_register_write
+        self._mqtt_client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc_task = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+        if not self._closing:
+            # There is no network thread to reconnect for us, so the event loop has to
+            if self._reconnect_task is None or self._reconnect_task.done():
+                self._reconnect_task = self._loop.create_task(self._reconnect())
+        elif self._disconnected is not None and not self._disconnected.done():
+            self._disconnected.set_result(True)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    def _start_replay(self):
+        if self._offline_queue is None:
+            return
+        with self._replay_lock:
+            if self._replaying or len(self._offline_queue) == 0:
+                return
+            self._replaying = True
+        self._loop.create_task(self._replay_task())
+
+    async def _replay_task(self):
+        interval = 1.0 / self._offline_queue.get_replay_rate()
+        while self._replay_next():
+            await asyncio.sleep(interval)
+
+    async def _reconnect(self):
+        delay = self.RECONNECT_MIN_DELAY
+        while not self._closing:
+            await asyncio.sleep(delay)
+            logging.info('MQTT reconnecting to host {}'.format(self._host))
+            try:
+                self._mqtt_client.reconnect()
+                return
+            except (OSError, ValueError):
+                logging.warning('MQTT failed to reconnect to host {}, retrying in {}s'.format(self._host, delay))
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+    async def _misc_loop(self):
+        while self._mqtt_client.loop_misc() == MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+    def __enter__(self):
+        assert False, "use 'async with' for AsyncMqtt"
+
+    def __exit__(self, *args):
+        assert False, "use 'async with' for AsyncMqtt"
+
+    async def __aenter__(self):
+        logging.info('MQTT connecting to host {}'.format(self._host))
+        self._loop = asyncio.get_event_loop()
+        self._closing = False
+        self._disconnected = self._loop.create_future()
+        self._mqtt_client.connect(self._host)
+        return self
+
+    async def __aexit__(self, *args):
+        logging.info('MQTT disconnecting from host {}'.format(self._host))
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._mqtt_client.socket() is None:
+            return  # Already disconnected while waiting to reconnect
+        self._mqtt_client.disconnect()
+        try:
+            await asyncio.wait_for(self._disconnected, 5)
+        except asyncio.TimeoutError:
+            logging.warning('MQTT timed out waiting for disconnect from host {}'.format(self._host))
+
+
+class ShardedMqtt:
+    def __init__(self, shards=2, offline_queue_factory=None, **kwargs):
+        assert shards > 0, 'shards must be positive'
+        # A queue replays over the connection that owns it, so each shard needs its own
+        assert kwargs.get('offline_queue') is None, 'shards cannot share an offline_queue, use offline_queue_factory'
+        kwargs.pop('offline_queue', None)
+        # The broker drops a connection when another one takes over its client_id, so each shard gets its own
+        client_id = kwargs.pop('client_id', None)
+        self._shards = [Mqtt(offline_queue=offline_queue_factory(i) if offline_queue_factory is not None else None,
+                             client_id='{}-{}'.format(client_id, i) if client_id else None,
+                             **kwargs) for i in range(shards)]
+
+    def _shard(self, topic):
+        # Topics of one entity share a connection, so their relative order is kept
+        key = topic.rsplit('/', 1)[0]
+        return self._shards[zlib.crc32(key.encode('utf-8')) % len(self._shards)]
+
+    def shards(self):
+        return list(self._shards)
+
+    def subscribe(self, topic, func, broker_filter=None, with_topic=False):
+        self._shard(broker_filter if broker_filter is not None else topic).subscribe(topic, func, broker_filter,
+                                                                                     with_topic)
+
+    def unsubscribe(self, topic, func, broker_filter=None, with_topic=False):
+        self._shard(broker_filter if broker_filter is not None else topic).unsubscribe(topic, func, broker_filter,
+                                                                                       with_topic)
+
+    def publish(self, topic, message, qos=0, retain=False):
+        return self._shard(topic).publish(topic, message, qos, retain)
+
+    def clear_publish_cache(self, topic=None):
+        if topic is not None:
+            self._shard(topic).clear_publish_cache(topic)
+        else:
+            for shard in self._shards:
+                shard.clear_publish_cache()
+
+    def add_reconnect_listener(self, func):
+        for shard in self._shards:
+            shard.add_reconnect_listener(func)
+
+    def get_serializer(self):
+        return self._shards[0].get_serializer()
+
+    def get_published_count(self):
+        return sum(shard.get_published_count() for shard in self._shards)
+
+    def get_suppressed_count(self):
+        return sum(shard.get_suppressed_count() for shard in self._shards)
+
+    def __enter__(self):
+        for shard in self._shards:
+            shard.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        for shard in self._shards:
+            shard.__exit__(*args)
 
 
 class MqttTopic:
@@ -88,33 +601,121 @@ class MqttTopic:
         assert message is not None, "message cannot be None"
         self._mqtt.publish(self._topic, message)
 
-    def subscribe(self, func):
-        self._mqtt.subscribe(self._topic, func)
+    def subscribe(self, func, broker_filter=None):
+        self._mqtt.subscribe(self._topic, func, broker_filter)
 
     def __len__(self):
         return 81484  # Duck typing
 
 
 class MqttSharedTopic(MqttTopic):
-    def __init__(self, mqtt, topic):
+    def __init__(self, mqtt, topic, keepalive_interval=None):
         super().__init__(mqtt, topic)
+        assert keepalive_interval is None or keepalive_interval > 0, 'keepalive_interval must be positive'
         self._values = {}
+        self._rendered = {}
+        self._fragments = {}
+        self._keepalive_interval = keepalive_interval
+        self._last_publish = None
+        # Fragments are encoded with the client's serializer, which may produce str or bytes
+        self._serializer = mqtt.get_serializer()
+        self._delimiters = ('{', ': ', ', ', '}')
+        if isinstance(self._serializer(''), bytes):
+            self._delimiters = tuple(d.encode('ascii') for d in self._delimiters)
 
     def add_entry(self, key, fun):
         self._values[key] = fun
         return "{{ value_json." + key + " }}"
 
+    def add_topic_entry(self, key, fun):
+        return self.name(), self.add_entry(key, fun)
+
     def publish(self, message=None):
         if message is not None:
             return
 
-        msg = {}
+        changed = False
         for k, f in self._values.items():
-            msg[k] = f()
+            value = f()
+            if value is None:
+                continue  # No value yet or the source failed, keep the last rendered one instead of sending null
+            if k not in self._rendered or self._rendered[k] != value:
+                self._rendered[k] = value
+                # Only re-encode what changed
+                self._fragments[k] = self._serializer(k) + self._delimiters[1] + self._serializer(value)
+                changed = True
+
+        now = time.monotonic()
+        if len(self._fragments) == 0:
+            return
+        if not changed and self._last_publish is not None and (
+                self._keepalive_interval is None or now - self._last_publish < self._keepalive_interval):
+            return
+        self._last_publish = now
+
+        msg = JsonMessage(self._rendered)
+        msg.encoded = self._delimiters[0] + \
+            self._delimiters[2].join(self._fragments[k] for k in self._values if k in self._fragments) + \
+            self._delimiters[3]
         super().publish(msg)
 
-    def subscribe(self, func):
+    def invalidate(self):
+        # The next publish goes out even when no value changed
+        self._last_publish = None
+
+    def subscribe(self, func, broker_filter=None):
         assert False, "you should not subscribe to shared topics"
 
     def __len__(self):
         return 48963  # Duck typing
+
+
+class ShardedSharedTopic(MqttSharedTopic):
+    def __init__(self, mqtt, topic, max_entries=None, max_bytes=None, value_size=16, keepalive_interval=None):
+        super().__init__(mqtt, topic, keepalive_interval)
+        assert max_entries is not None or max_bytes is not None, 'max_entries and max_bytes cannot both be None'
+        assert max_entries is None or max_entries > 0, 'max_entries must be positive'
+        assert max_bytes is None or max_bytes > 0, 'max_bytes must be positive'
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._value_size = value_size
+        self._shards = []
+        self._shard_entries = 0
+        self._shard_bytes = 0
+
+    def _entry_size(self, key):
+        # Values are not known up front, so estimate them with a fixed size
+        return len(json.dumps(key)) + len(': , ') + self._value_size
+
+    def _shard_for(self, key):
+        size = self._entry_size(key)
+        full = len(self._shards) == 0 or \
+            (self._max_entries is not None and self._shard_entries >= self._max_entries) or \
+            (self._max_bytes is not None and self._shard_entries > 0 and self._shard_bytes + size > self._max_bytes)
+        if full:
+            self._shards.append(MqttSharedTopic(self._mqtt, '{}/{}'.format(self._topic, len(self._shards)),
+                                                self._keepalive_interval))
+            self._shard_entries = 0
+            self._shard_bytes = 2  # Braces
+        self._shard_entries = self._shard_entries + 1
+        self._shard_bytes = self._shard_bytes + size
+        return self._shards[-1]
+
+    def add_entry(self, key, fun):
+        return self.add_topic_entry(key, fun)[1]
+
+    def add_topic_entry(self, key, fun):
+        return self._shard_for(key).add_topic_entry(key, fun)
+
+    def shards(self):
+        return list(self._shards)
+
+    def publish(self, message=None):
+        if message is not None:
+            return
+        for shard in self._shards:
+            shard.publish()
+
+    def invalidate(self):
+        for shard in self._shards:
+            shard.invalidate()
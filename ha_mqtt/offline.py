@@ -0,0 +1,114 @@
+import base64
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+class OfflineQueue:
+    def __init__(self, path, max_messages=10000, replay_rate=50):
+        assert path is not None, 'path cannot be None'
+        assert max_messages > 0, 'max_messages must be positive'
+        assert replay_rate > 0, 'replay_rate must be positive'
+
+        self._path = path
+        self._max_messages = max_messages
+        self._replay_rate = replay_rate
+        self._lock = threading.Lock()
+        self._messages = OrderedDict()  # Only the newest message per topic is kept, oldest first
+        self._records = 0
+        self._dropped = 0
+
+        self._load()
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def _encode(topic, payload, qos, retain):
+        return json.dumps({
+            'topic': topic,
+            'payload': base64.b64encode(payload).decode('ascii'),
+            'qos': qos,
+            'retain': retain
+        }) + '\n'
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if record.get('discard', False):
+                        self._messages.pop(record['topic'], None)
+                        continue
+                    payload = base64.b64decode(record['payload'])
+                except (ValueError, KeyError):
+                    logging.warning('MQTT skipping corrupt offline queue record in {}'.format(self._path))
+                    continue
+                self._messages.pop(record['topic'], None)
+                self._messages[record['topic']] = (payload, record['qos'], record['retain'])
+                self._records = self._records + 1
+        self._trim()
+        if len(self._messages) > 0:
+            logging.info('MQTT loaded {} queued messages from {}'.format(len(self._messages), self._path))
+
+    def _trim(self):
+        while len(self._messages) > self._max_messages:
+            self._messages.popitem(last=False)
+            self._dropped = self._dropped + 1
+
+    def _compact(self):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for topic, (payload, qos, retain) in self._messages.items():
+                f.write(self._encode(topic, payload, qos, retain))
+        self._file.close()
+        os.replace(tmp, self._path)
+        self._file = open(self._path, 'a', encoding='utf-8')
+        self._records = len(self._messages)
+
+    def put(self, topic, payload, qos=0, retain=False):
+        payload = payload.encode('utf-8') if isinstance(payload, str) else bytes(payload)
+        with self._lock:
+            self._messages.pop(topic, None)  # A newer value supersedes the queued one
+            self._messages[topic] = (payload, qos, retain)
+            self._file.write(self._encode(topic, payload, qos, retain))
+            self._file.flush()
+            self._records = self._records + 1
+            self._trim()
+            if self._records > 2 * self._max_messages:
+                self._compact()
+
+    def pop(self):
+        with self._lock:
+            if len(self._messages) == 0:
+                return None
+            topic, (payload, qos, retain) = self._messages.popitem(last=False)
+            if len(self._messages) == 0:
+                self._compact()  # Everything has been replayed, truncate the file
+            return topic, payload, qos, retain
+
+    def discard(self, topic):
+        with self._lock:
+            if self._messages.pop(topic, None) is None:
+                return
+            # Recorded too, otherwise a restart would load the stale value again
+            self._file.write(json.dumps({'topic': topic, 'discard': True}) + '\n')
+            self._file.flush()
+            self._records = self._records + 1
+            if len(self._messages) == 0:
+                self._compact()
+
+    def get_replay_rate(self):
+        return self._replay_rate
+
+    def get_dropped_count(self):
+        return self._dropped
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __len__(self):
+        return len(self._messages)
@@ -1,36 +1,384 @@
+import asyncio
+import contextvars
+import heapq
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
 import yaml
 
-from ha_mqtt.util import sleep_for
+from ha_mqtt.ha import EvaluationContext, DISCOVERY_PREFIX
+from ha_mqtt.util import sleep_for, _running_loop
+
+
+class _Entry:
+    def __init__(self, component, send_updates, timeout, interval=None, phase=0, jitter=0):
+        assert interval is None or interval > 0, 'interval must be positive'
+        assert phase >= 0, 'phase cannot be negative'
+        assert jitter >= 0, 'jitter cannot be negative'
+
+        self.component = component
+        self.send_updates = send_updates
+        self.timeout = timeout
+        self.interval = interval
+        self.phase = phase
+        self.jitter = jitter
+        self.future = None
+        self.timed_out = False
+
+
+class _TopicEntry(_Entry):
+    def __init__(self, topic, interval=None, phase=0, jitter=0):
+        super().__init__(topic, True, None, interval, phase, jitter)
+
+
+class _Schedule:
+    def __init__(self, start, default_interval):
+        self._heap = []
+        self._seq = 0
+        self._start = start
+        self._default_interval = default_interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.skipped = 0
+
+    def add(self, entry):
+        self._push(self._start + entry.phase, entry)
+
+    def _push(self, due, entry):
+        wake = due + (random.uniform(0, entry.jitter) if entry.jitter > 0 else 0)
+        self._seq = self._seq + 1
+        heapq.heappush(self._heap, (wake, self._seq, due, entry))
+
+    def next_wake(self):
+        if len(self._heap) == 0:
+            return time.monotonic() + self._default_interval
+        return self._heap[0][0]
+
+    def pop_due(self, now):
+        due = []
+        if len(self._heap) > 0:
+            self.lag = max(0.0, now - self._heap[0][0])
+            self.max_lag = max(self.max_lag, self.lag)
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            _, _, base, entry = heapq.heappop(self._heap)
+            due.append(entry)
+
+            # Schedule from the previous due time, not from now, so drift does not accumulate
+            interval = entry.interval if entry.interval is not None else self._default_interval
+            base = base + interval
+            if base <= now:
+                missed = int((now - base) // interval) + 1
+                self.skipped = self.skipped + missed
+                base = base + missed * interval
+            self._push(base, entry)
+        return due
+
+
+class _Announcer:
+    BATCH_PERIOD = 0.1
+
+    def __init__(self, rate):
+        assert rate is None or rate > 0, 'rate must be positive'
+        self._batch_size = None if rate is None else int(math.ceil(rate * self.BATCH_PERIOD))
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._topics = []
+        self._discovery = False
+        self._running = False
+        self._announced = 0
+
+    def announce(self, entries, topics, discovery=True):
+        with self._lock:
+            # A newer announcement supersedes whatever is left of the previous one
+            self._pending = deque(entries)
+            self._topics = list(topics)
+            self._discovery = discovery
+            if self._running:
+                return
+            self._running = True
+
+        if self._batch_size is None:
+            while self._announce_batch():
+                pass
+            return
+        loop = _running_loop()
+        if loop is not None:
+            loop.create_task(self._run_async())
+        else:
+            threading.Thread(target=self._run, name='announcer', daemon=True).start()
+
+    def cancel(self):
+        with self._lock:
+            self._pending.clear()
+            self._topics = []
+
+    def _run(self):
+        while self._announce_batch():
+            time.sleep(self.BATCH_PERIOD)
+
+    async def _run_async(self):
+        while self._announce_batch():
+            await asyncio.sleep(self.BATCH_PERIOD)
+
+    def _announce_batch(self):
+        with self._lock:
+            if len(self._pending) == 0 and len(self._topics) == 0:
+                self._running = False
+                return False
+            size = len(self._pending) if self._batch_size is None else self._batch_size
+            batch = [self._pending.popleft() for _ in range(min(size, len(self._pending)))]
+            discovery = self._discovery
+            topics = []
+            if len(self._pending) == 0:
+                topics, self._topics = self._topics, []  # Shared topics follow once every component is back
+
+        for e in batch:
+            try:
+                if discovery:
+                    e.component.announce()
+                e.component.available_set(True)
+                if e.send_updates:
+                    e.component.send_current_state()
+            except:
+                logging.error('Error announcing component {}'.format(e.component.get_id()), exc_info=True)
+            self._announced = self._announced + 1
+        for q in topics:
+            q.component.invalidate()
+            q.component.publish()
+        return True
+
+    def get_announced_count(self):
+        return self._announced
 
 
 class ComponentRegistry:
-    def __init__(self):
+    def __init__(
+            self,
+            workers=None,
+            update_timeout=None,
+            unavailable_on_timeout=False,
+            discovery_timeout=10,
+            mqtt=None,
+            announce_rate=500,
+            retain_discovery=False,
+            retained_quiet=0.5,
+            compact_discovery=False
+    ):
+        assert workers is None or workers > 0, 'workers must be positive'
+        assert not retain_discovery or mqtt is not None, 'retain_discovery needs mqtt to read the retained configs'
+        assert retained_quiet > 0, 'retained_quiet must be positive'
+
         self._components = []
         self._shared_topics = []
+        self._workers = workers
+        self._update_timeout = update_timeout
+        self._unavailable_on_timeout = unavailable_on_timeout
+        self._discovery_timeout = discovery_timeout
+        self._executor = None
+        self._stopped = threading.Event()
+        self._stopped_async = None
+        self._loop = None
+        self._schedule = None
+        self._evaluation_context = EvaluationContext()
+        self._mqtt = mqtt
+        self._announcer = _Announcer(announce_rate)
+        self._status_topic = DISCOVERY_PREFIX + '/status'
+        self._paused = False
+        self._retain_discovery = retain_discovery
+        self._compact_discovery = compact_discovery
+        self._retained_quiet = retained_quiet
+        self._retained = {}
+        self._retained_at = None
+        self._retained_lock = threading.Lock()
 
-    def _add_component(self, component, send_updates):
-        self._components.append((component, send_updates))
+    def _add_component(self, component, send_updates, timeout, interval, phase, jitter):
+        component.set_evaluation_context(self._evaluation_context)
+        if self._retain_discovery:
+            component.set_retain_discovery(True)
+        if self._compact_discovery:
+            component.set_compact_discovery(True)
+        self._components.append(_Entry(component, send_updates, timeout, interval, phase, jitter))
 
-    def add_component(self, component, send_updates=True):
+    def add_component(self, component, send_updates=True, timeout=None, interval=None, phase=0, jitter=0):
+        if timeout is None:
+            timeout = self._update_timeout
         if isinstance(component, list):
             for c in component:
-                self._add_component(c, send_updates)
+                self._add_component(c, send_updates, timeout, interval, phase, jitter)
         else:
-            self._add_component(component, send_updates)
+            self._add_component(component, send_updates, timeout, interval, phase, jitter)
 
-    def add_shared_topic(self, topic):
+    def _add_shared_topic(self, topic, interval, phase, jitter):
+        self._shared_topics.append(_TopicEntry(topic, interval, phase, jitter))
+
+    def add_shared_topic(self, topic, interval=None, phase=0, jitter=0):
         if isinstance(topic, list):
             for t in topic:
-                self._shared_topics.append(t)
+                self._add_shared_topic(t, interval, phase, jitter)
         else:
-            self._shared_topics.append(topic)
+            self._add_shared_topic(topic, interval, phase, jitter)
 
     def send_updates(self, force_all=False):
-        for c, send_updates in self._components:
-            if send_updates or force_all:
-                c.send_update()
+        entries = [e for e in self._components if e.send_updates or force_all]
+        self._send_updates(entries, self._shared_topics)
+
+    def _send_updates(self, entries, topics):
+        if self._paused:
+            return
+        token = self._evaluation_context.open()
+        try:
+            if self._workers is None:
+                for e in entries:
+                    e.component.send_update()
+            else:
+                self._send_updates_concurrently(entries)
+            for q in topics:
+                q.component.publish()
+        finally:
+            self._evaluation_context.close(token)
+
+    def _create_schedule(self, interval):
+        self._schedule = _Schedule(time.monotonic(), interval)
+        for e in self._components:
+            if e.send_updates:
+                self._schedule.add(e)
         for q in self._shared_topics:
-            q.publish()
+            self._schedule.add(q)
+        return self._schedule
+
+    def _pop_due(self, schedule):
+        due = schedule.pop_due(time.monotonic())
+        return [e for e in due if not isinstance(e, _TopicEntry)], [e for e in due if isinstance(e, _TopicEntry)]
+
+    def run(self, interval=1):
+        assert interval > 0, 'interval must be positive'
+        self._stopped.clear()
+        schedule = self._create_schedule(interval)
+        while not self._stopped.is_set():
+            delay = schedule.next_wake() - time.monotonic()
+            if delay > 0 and self._stopped.wait(delay):
+                break
+            entries, topics = self._pop_due(schedule)
+            self._send_updates(entries, topics)
+
+    async def run_async(self, interval=1):
+        assert interval > 0, 'interval must be positive'
+        self._stopped.clear()
+        self._loop = asyncio.get_running_loop()
+        self._stopped_async = asyncio.Event()
+        schedule = self._create_schedule(interval)
+        while not self._stopped.is_set():
+            delay = schedule.next_wake() - time.monotonic()
+            if delay > 0:
+                # Waiting on the event instead of sleeping lets stop() interrupt long intervals
+                try:
+                    await asyncio.wait_for(self._stopped_async.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            entries, topics = self._pop_due(schedule)
+            await self._send_updates_async(entries, topics)
+
+    def stop(self):
+        self._stopped.set()
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stopped_async.set)
+
+    def get_loop_lag(self):
+        return self._schedule.lag if self._schedule is not None else 0.0
+
+    def get_max_loop_lag(self):
+        return self._schedule.max_lag if self._schedule is not None else 0.0
+
+    def get_skipped_updates(self):
+        return self._schedule.skipped if self._schedule is not None else 0
+
+    def _send_updates_concurrently(self, entries):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers)
+
+        submitted = []
+        for e in entries:
+            if e.future is not None and not e.future.done():
+                continue  # Still busy with the previous cycle, keep the last value
+            # Workers run in a copy of this context so they share the open evaluation epoch
+            e.future = self._executor.submit(contextvars.copy_context().run, e.component.send_update)
+            submitted.append(e)
+
+        started = time.monotonic()
+        for e in submitted:
+            remaining = None if e.timeout is None else max(0.0, started + e.timeout - time.monotonic())
+            try:
+                e.future.result(remaining)
+            except TimeoutError:
+                self._timed_out(e, True)
+            else:
+                self._timed_out(e, False)
+
+    async def send_updates_async(self, force_all=False):
+        entries = [e for e in self._components if e.send_updates or force_all]
+        await self._send_updates_async(entries, self._shared_topics)
+
+    async def _send_updates_async(self, entries, topics):
+        if self._paused:
+            return
+        token = self._evaluation_context.open()
+        try:
+            await asyncio.gather(*[self._send_update_async(e) for e in entries])
+            for q in topics:
+                q.component.publish()
+        finally:
+            self._evaluation_context.close(token)
+
+    async def _send_update_async(self, entry):
+        try:
+            if entry.timeout is None:
+                await entry.component.send_update_async()
+            else:
+                await asyncio.wait_for(entry.component.send_update_async(), entry.timeout)
+        except asyncio.TimeoutError:
+            self._timed_out(entry, True)
+        else:
+            self._timed_out(entry, False)
+
+    def _timed_out(self, entry, timed_out):
+        if entry.timed_out == timed_out:
+            return
+        entry.timed_out = timed_out
+        if timed_out:
+            logging.warning('Component {} timed out sending update'.format(entry.component.get_id()))
+        else:
+            logging.info('Component {} recovered from timeout'.format(entry.component.get_id()))
+        if self._unavailable_on_timeout:
+            entry.component.hold_unavailable(self, timed_out)
+
+    def _on_reconnect(self, session_present):
+        # Without a session the broker restarted or expired us, so the discovery configs are sent again too
+        logging.info('Re-announcing {} components after reconnect'.format(len(self._components)))
+        self._announcer.announce(self._components, self._shared_topics, discovery=not session_present)
+
+    def _on_ha_status(self, status):
+        if status == 'online':
+            # Home Assistant (re)started and forgot every entity that was not retained
+            logging.info('Home Assistant is online, re-announcing {} components'.format(len(self._components)))
+            self._paused = False
+            self._mqtt.clear_publish_cache()  # Everything has to go out again, even if unchanged
+            self._announcer.announce(self._components, self._shared_topics)
+        elif status == 'offline':
+            logging.info('Home Assistant is offline, pausing state updates')
+            self._paused = True
+            self._announcer.cancel()
+
+    def is_paused(self):
+        return self._paused
+
+    def get_announced_count(self):
+        return self._announcer.get_announced_count()
 
     def create_config(self):
         sensor = []
@@ -39,7 +387,8 @@ class ComponentRegistry:
         input_number = {}
         automation = []
 
-        for c, _ in self._components:
+        for e in self._components:
+            c = e.component
             tmp = c.get_config()
             tmp['platform'] = 'mqtt'
             if len(c) == 29175:
@@ -96,16 +445,116 @@ class ComponentRegistry:
             'automation': automation,
         }, encoding='utf-8', allow_unicode=True, default_flow_style=False, explicit_start=True).decode("utf-8")
 
+    def _pending_discovery(self):
+        return [e for e in self._components if not e.component.is_discovered()]
+
+    def _discovery_timed_out(self, pending):
+        logging.warning('Discovery of {} components not acknowledged within {}s'.format(
+            len(pending), self._discovery_timeout))
+
+    def _retained_filters(self):
+        # Only configs under our own nodes can be diffed, components without a node are always published
+        nodes = sorted(set(e.component.get_node_id() for e in self._components if e.component.get_node_id()))
+        return ['{}/+/{}/+/config'.format(DISCOVERY_PREFIX, node) for node in nodes]
+
+    def _on_retained_config(self, topic, payload):
+        with self._retained_lock:
+            self._retained[topic] = payload
+            self._retained_at = time.monotonic()
+
+    def _retained_subscribe(self):
+        self._retained = {}
+        self._retained_at = time.monotonic()
+        filters = self._retained_filters()
+        for f in filters:
+            self._mqtt.subscribe(f, self._on_retained_config, with_topic=True)
+        return filters
+
+    def _retained_collected(self, deadline):
+        # Retained messages arrive right after the subscription, so they are done once the topic goes quiet
+        now = time.monotonic()
+        with self._retained_lock:
+            return now >= deadline or now - self._retained_at >= self._retained_quiet
+
+    def _retained_apply(self, filters):
+        for f in filters:
+            self._mqtt.unsubscribe(f, self._on_retained_config, with_topic=True)
+        with self._retained_lock:
+            retained = {t: p for t, p in self._retained.items() if p}
+            self._retained = {}
+
+        unchanged = 0
+        for e in self._components:
+            e.component.set_retained_config(retained.pop(e.component.topic_name('config'), None))
+            if e.component.is_config_retained():
+                unchanged = unchanged + 1
+        for topic in retained:
+            logging.info('HASS removing stale component config {}'.format(topic))
+            self._mqtt.publish(topic, None, qos=1, retain=True)
+        logging.info('HASS discovery: {} unchanged, {} to publish, {} stale'.format(
+            unchanged, len(self._components) - unchanged, len(retained)))
+
+    def _listen(self):
+        if self._mqtt is not None:
+            self._mqtt.add_reconnect_listener(self._on_reconnect)
+            self._mqtt.subscribe(self._status_topic, self._on_ha_status)
+
     def __enter__(self):
-        for c, _ in self._components:
-            c.__enter__()
+        self._listen()
+        if self._retain_discovery:
+            filters = self._retained_subscribe()
+            deadline = time.monotonic() + self._discovery_timeout
+            while not self._retained_collected(deadline):
+                sleep_for(0.01)
+            self._retained_apply(filters)
+        for e in self._components:
+            e.component.__enter__()
 
-        sleep_for(1)  # Give home assistant a chance to catch up
+        # Wait for the broker to acknowledge the discovery configs before announcing availability
+        deadline = time.monotonic() + self._discovery_timeout
+        pending = self._pending_discovery()
+        while len(pending) > 0 and time.monotonic() < deadline:
+            sleep_for(0.01)
+            pending = [e for e in pending if not e.component.is_discovered()]
+        if len(pending) > 0:
+            self._discovery_timed_out(pending)
 
-        for c, _ in self._components:
-            c.available_set(True)
+        for e in self._components:
+            e.component.available_set(True)
         return self
 
+    async def __aenter__(self):
+        self._listen()
+        if self._retain_discovery:
+            filters = self._retained_subscribe()
+            deadline = time.monotonic() + self._discovery_timeout
+            while not self._retained_collected(deadline):
+                await asyncio.sleep(0.01)
+            self._retained_apply(filters)
+        for e in self._components:
+            e.component.__enter__()
+
+        deadline = time.monotonic() + self._discovery_timeout
+        pending = self._pending_discovery()
+        while len(pending) > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+            pending = [e for e in pending if not e.component.is_discovered()]
+        if len(pending) > 0:
+            self._discovery_timed_out(pending)
+
+        for e in self._components:
+            e.component.available_set(True)
+        return self
+
+    async def __aexit__(self, *args):
+        self.__exit__(*args)
+
     def __exit__(self, *args):
-        for c, _ in self._components:
-            c.__exit__(args)
+        if self._mqtt is not None:
+            self._mqtt.unsubscribe(self._status_topic, self._on_ha_status)
+        self._announcer.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        for e in self._components:
+            e.component.__exit__(args)
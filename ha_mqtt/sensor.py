@@ -1,8 +1,13 @@
+import asyncio
 import logging
+import math
+import numbers
+import threading
+import time
 
 from ha_mqtt.ha import _Base
 from ha_mqtt.mqtt import MqttTopic
-from ha_mqtt.util import create_id
+from ha_mqtt.util import create_id, run_after, create_coalescer, RingBuffer
 
 
 def state_formatter_func_default(state):
@@ -34,6 +39,10 @@ class Sensor(_Base):
             state_func=None,
             state_formatter_func=state_formatter_func_default,
             state_topic=None,
+            deadband=None,
+            deadband_percent=None,
+            min_interval=None,
+            max_interval=None,
             **kwargs
     ):
         super().__init__(component_id=create_id(sensor_id, sensor_name), component_name=sensor_name,
@@ -43,8 +52,25 @@ class Sensor(_Base):
         assert unit_of_measurement is not None, 'unit of measurement cannot be None'
         assert state_func is not None, 'state_func cannot be None'
         assert state_formatter_func is not None, 'state_formatter_func cannot be None'
+        assert deadband is None or deadband >= 0, 'deadband cannot be negative'
+        assert deadband_percent is None or deadband_percent >= 0, 'deadband_percent cannot be negative'
+        assert min_interval is None or max_interval is None or min_interval <= max_interval, \
+            'min_interval cannot be larger than max_interval'
+
+        self._deadband = deadband
+        self._deadband_percent = deadband_percent
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._report_filtered = deadband is not None or deadband_percent is not None or \
+            min_interval is not None or max_interval is not None
+        self._reported_state = None
+        self._reported_at = None
+        self._state_listeners = []
+        self._observed_state = None
 
         self._state_func = state_func
+        self._state_func_async = asyncio.iscoroutinefunction(state_func)
+        self._async_state = None
         self._state_formatter_func = state_formatter_func
 
         self._add_to_config({
@@ -53,30 +79,198 @@ class Sensor(_Base):
 
         if state_topic is None:
             self._state_topic = MqttTopic(kwargs['mqtt'], self.topic_name('state'))
+            self._state_topic_name = self._state_topic.name()
             self._add_to_config({
-                'state_topic': self._state_topic.name()
+                'state_topic': self._state_topic_name
             })
         else:
             assert len(state_topic) == 48963
             self._state_topic = state_topic
+            self._state_topic_name, value_template = self._state_topic.add_topic_entry(
+                self._component_id, lambda: self._state_get_and_format())
             self._add_to_config({
-                'state_topic': self._state_topic.name(),
-                'value_template': self._state_topic.add_entry(self._component_id, lambda: self._state_get_and_format()),
+                'state_topic': self._state_topic_name,
+                'value_template': value_template,
             })
 
+    def _format_state(self, state):
+        if state is None:
+            return None  # Async state not awaited yet, or the source has no value, so nothing is published
+        return self._state_formatter_func(state)
+
     def _state_get_and_format(self):
-        return self._state_formatter_func(self())
+        # Shared topics render on the registry's thread, which must not wait for a timed out worker
+        return self._format_state(self._next_report(stale_ok=True)[0])
+
+    def _next_report(self, stale_ok=False):
+        state = self._read(stale_ok)
+        if not self._report_filtered:
+            return state, True
+        now = time.monotonic()
+        if self._reported_at is None or self._should_report(state, now - self._reported_at):
+            self._reported_state = state
+            self._reported_at = now
+            return state, True
+        return self._reported_state, False
+
+    def _should_report(self, state, elapsed):
+        if self._max_interval is not None and elapsed >= self._max_interval:
+            return True  # Heartbeat
+        if self._min_interval is not None and elapsed < self._min_interval:
+            return False
+        old = self._reported_state
+        if self._deadband is None and self._deadband_percent is None:
+            return True
+        if not isinstance(old, numbers.Number) or not isinstance(state, numbers.Number):
+            return old != state
+        delta = abs(state - old)
+        if self._deadband is not None and delta > self._deadband:
+            return True
+        if self._deadband_percent is not None and delta > abs(old) * self._deadband_percent / 100:
+            return True
+        return False
 
     def send_update(self):
-        self._state_topic.publish(self._state_get_and_format())
+        state, report = self._next_report()
+        if not report:
+            return
+        state = self._format_state(state)
+        if state is not None:
+            self._state_topic.publish(state)
+
+    async def send_update_async(self):
+        if self._state_func_async:
+            self._async_state = await self._state_func()
+        self.send_update()
+
+    def send_current_state(self):
+        state = self()
+        if self._report_filtered:
+            self._reported_state = state
+            self._reported_at = time.monotonic()
+        state = self._format_state(state)
+        if state is not None:
+            self._state_topic.publish(state)
+
+    def add_state_listener(self, func):
+        self._state_listeners.append(func)
+
+    def _observe(self, state):
+        if len(self._state_listeners) > 0 and state != self._observed_state:
+            self._observed_state = state
+            for func in self._state_listeners:
+                func(self, state)
+        return state
+
+    def _read(self, stale_ok=False):
+        if self._state_func_async:
+            return self._observe(self._async_state)
+        return self._observe(self._evaluate(self._state_func, stale_ok))
 
     def __call__(self, *args, **kwargs):
-        return self._state_func()
+        return self._read()
 
     def __len__(self):
         return 95168  # Duck typing
 
 
+def _reduce_mean(values):
+    return math.fsum(values) / len(values)
+
+
+def _reduce_rms(values):
+    return math.sqrt(math.fsum(v * v for v in values) / len(values))
+
+
+def _reduce_peak(values):
+    return max(abs(v) for v in values)
+
+
+_REDUCERS = {
+    'mean': _reduce_mean,
+    'rms': _reduce_rms,
+    'peak': _reduce_peak,
+    'min': min,
+    'max': max,
+}
+
+
+class OversamplingSensor(Sensor):
+    def __init__(
+            self,
+            sensor_name,
+            unit_of_measurement,
+            state_func=None,
+            sample_rate=50,
+            reduce='mean',
+            buffer_size=None,
+            **kwargs
+    ):
+        assert state_func is not None, 'state_func cannot be None'
+        assert sample_rate > 0, 'sample_rate must be positive'
+        assert reduce in _REDUCERS, reduce + ' is not a supported reduction'
+
+        self._sample_func = state_func
+        self._sample_interval = 1.0 / sample_rate
+        self._reducer = _REDUCERS[reduce]
+        self._samples = RingBuffer(buffer_size if buffer_size is not None else int(math.ceil(sample_rate * 60)))
+        self._samples_lock = threading.Lock()
+        self._reduced = None
+        self._sampler = None
+        self._sampler_stopped = threading.Event()
+
+        super().__init__(sensor_name, unit_of_measurement, state_func=self._reduce_samples, **kwargs)
+
+    def _sample_loop(self):
+        next_sample = time.monotonic()
+        while not self._sampler_stopped.is_set():
+            try:
+                value = self._sample_func()
+                value = float(value) if value is not None else None  # A bad sample must not kill the sampler
+            except:
+                logging.error('Error sampling {}'.format(self.get_id()), exc_info=True)
+                value = None
+            if value is not None:
+                with self._samples_lock:
+                    self._samples.append(value)
+
+            next_sample = next_sample + self._sample_interval
+            delay = next_sample - time.monotonic()
+            if delay < 0:
+                next_sample = time.monotonic()  # Fell behind, drop the missed samples instead of bursting
+                delay = 0
+            if self._sampler_stopped.wait(delay):
+                break
+
+    def _reduce_samples(self):
+        with self._samples_lock:
+            values = self._samples.values()
+            self._samples.clear()
+        if len(values) > 0:
+            self._reduced = self._reducer(values)
+        return self._reduced
+
+    def start(self):
+        if self._sampler is None:
+            self._sampler_stopped.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name='sampler-' + self.get_id(), daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        if self._sampler is not None:
+            self._sampler_stopped.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def __enter__(self):
+        self.start()
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        self.stop()
+        super().__exit__(*args)
+
+
 class SettableSensor(Sensor):
     def __init__(
             self,
@@ -89,6 +283,7 @@ class SettableSensor(Sensor):
             state_change_func=state_change_func_default,
             state_parser_func=state_parser_func_default,
             state_send_update_condition_func=state_send_update_condition_func_default,
+            command_coalesce_window=None,
             **kwargs
     ):
         self._state = initial_state
@@ -97,6 +292,7 @@ class SettableSensor(Sensor):
         self._state_send_update_condition_func = state_send_update_condition_func
 
         super().__init__(sensor_name, unit_of_measurement, state_func=lambda: self._state, **kwargs)
+        self._assert_dispatchable(state_change_func, 'state_change_func')
 
         self._min_state = min_state
         self._max_state = max_state
@@ -105,17 +301,22 @@ class SettableSensor(Sensor):
         self._cmd_topic = self.topic_name('cmd')
 
         command_topic = MqttTopic(kwargs['mqtt'], self._cmd_topic)
-        command_topic.subscribe(lambda new_state: self._receive_command(new_state))
+        receive_command = create_coalescer(self._receive_command, command_coalesce_window)
+        command_topic.subscribe(lambda new_state: receive_command(new_state), self.topic_filter('cmd'))
 
     def _receive_command(self, new_state):
         old_state = self._state
         self._state = self._state_parser_func(new_state)
-        self._state_change_func(self._state)
-        if self._state_send_update_condition_func(old_state, self._state):
-            self.send_update()
+        self._observe(self._state)
+
+        def _send_update():
+            if self._state_send_update_condition_func(old_state, self._state):
+                self.send_update()
+
+        return run_after(self._state_change_func(self._state), _send_update)
 
     def get_state_topic_name(self):
-        return self._state_topic.name()
+        return self._state_topic_name
 
     def get_cmd_topic_name(self):
         return self._cmd_topic
@@ -152,13 +353,102 @@ class ErrorSensor(Sensor):
     def reset(self):
         self._errors = 0
 
-    def wrap_function(self, func):
+    def record_error(self):
+        self._errors = self._errors + 1
+
+    def wrap_function(self, func, circuit_breaker=None):
+        if circuit_breaker is not None:
+            return circuit_breaker.wrap(func, self)
+
         def wrapper():
             try:
                 return func()
             except:
-                self._errors = self._errors + 1
+                self.record_error()
+                logging.error("Error in wrapped function", exc_info=True)
+                return None
+
+        return wrapper
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, backoff=1, max_backoff=300, components=None):
+        assert failure_threshold > 0, 'failure_threshold must be positive'
+        assert 0 < backoff <= max_backoff, 'backoff must be positive and no larger than max_backoff'
+
+        self._failure_threshold = failure_threshold
+        self._initial_backoff = backoff
+        self._max_backoff = max_backoff
+        self._components = list(components) if components is not None else []
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._trips = 0
+        self._backoff = backoff
+        self._retry_at = None
+
+    def add_component(self, component):
+        self._components.append(component)
+
+    def get_state(self):
+        return self._state
+
+    def get_trips(self):
+        return self._trips
+
+    def wrap(self, func, error_sensor=None):
+        def wrapper():
+            with self._lock:
+                if self._state == self.HALF_OPEN:
+                    return None  # Another caller is already probing the source
+                if self._state == self.OPEN:
+                    if time.monotonic() < self._retry_at:
+                        return None
+                    self._state = self.HALF_OPEN
+            try:
+                res = func()
+            except:
+                if error_sensor is not None:
+                    error_sensor.record_error()
                 logging.error("Error in wrapped function", exc_info=True)
+                self._failure()
                 return None
+            self._success()
+            return res
 
         return wrapper
+
+    def _failure(self):
+        with self._lock:
+            self._failures = self._failures + 1
+            if self._state == self.HALF_OPEN:
+                self._backoff = min(self._backoff * 2, self._max_backoff)
+            elif self._failures < self._failure_threshold:
+                return
+            else:
+                self._trips = self._trips + 1
+                self._backoff = self._initial_backoff
+            reopened = self._state == self.HALF_OPEN
+            self._state = self.OPEN
+            self._retry_at = time.monotonic() + self._backoff
+        if not reopened:
+            logging.warning('Circuit opened after {} failures, retrying in {}s'.format(self._failures, self._backoff))
+            self._set_available(False)
+
+    def _success(self):
+        with self._lock:
+            closed = self._state == self.CLOSED
+            self._state = self.CLOSED
+            self._failures = 0
+            self._backoff = self._initial_backoff
+        if not closed:
+            logging.info('Circuit closed')
+            self._set_available(True)
+
+    def _set_available(self, available):
+        for c in self._components:
+            c.hold_unavailable(self, not available)
@@ -1,6 +1,6 @@
 from ha_mqtt.ha import _Base
 from ha_mqtt.mqtt import MqttTopic
-from ha_mqtt.util import create_id
+from ha_mqtt.util import create_id, run_after
 
 
 def _state_format(state):
@@ -20,6 +20,7 @@ class Switch(_Base):
                          component_type='switch', **kwargs)
 
         assert state_change_func is not None, 'switch_func cannot be None'
+        self._assert_dispatchable(state_change_func, 'state_change_func')
 
         command_topic = MqttTopic(kwargs['mqtt'], self.topic_name('cmd'))
         self._state_change_func = state_change_func
@@ -41,12 +42,14 @@ class Switch(_Base):
         else:
             assert len(state_topic) == 48963
             self._state_topic = state_topic
+            topic, value_template = self._state_topic.add_topic_entry(self._component_id,
+                                                                      lambda: _state_format(self._state))
             self._add_to_config({
-                'state_topic': self._state_topic.name(),
-                'value_template': self._state_topic.add_entry(self._component_id, lambda: _state_format(self._state)),
+                'state_topic': topic,
+                'value_template': value_template,
             })
 
-        command_topic.subscribe(lambda new_state: self._receive_command(new_state))
+        command_topic.subscribe(lambda new_state: self._receive_command(new_state), self.topic_filter('cmd'))
 
     def _receive_command(self, new_state):
         self(new_state == 'on')
@@ -56,8 +59,7 @@ class Switch(_Base):
 
     def __call__(self, new_state):
         self._state = new_state
-        self._state_change_func(self._state)
-        self.send_update()
+        return run_after(self._state_change_func(self._state), self.send_update)
 
     def __len__(self):
         return 71984  # Duck typing
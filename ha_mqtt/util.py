@@ -1,7 +1,11 @@
+import asyncio
+import inspect
 import logging
 import os
 import sys
+import threading
 import time
+from array import array
 
 
 def env(key, default=None):
@@ -67,3 +71,94 @@ def create_id(c_id, c_name):
 
 def id_from_name(name):
     return name.replace(" ", "_").lower()
+
+
+def run_after(result, func):
+    if inspect.isawaitable(result):
+        async def _wait():
+            await result
+            func()
+
+        return asyncio.ensure_future(_wait())
+    func()
+
+
+def create_coalescer(func, window=None):
+    if window is None:
+        return func
+    return _Coalescer(func, window)
+
+
+class _Coalescer:
+    def __init__(self, func, window):
+        assert window > 0, 'window must be positive'
+        self._func = func
+        self._window = window
+        self._lock = threading.Lock()
+        self._value = None
+        self._pending = False
+
+    def __call__(self, value):
+        with self._lock:
+            self._value = value
+            if self._pending:
+                return
+            self._pending = True
+
+        loop = _running_loop()
+        if loop is not None:
+            loop.call_later(self._window, self._flush)
+        else:
+            timer = threading.Timer(self._window, self._flush)
+            timer.daemon = True
+            timer.start()
+
+    def _flush(self):
+        with self._lock:
+            value = self._value
+            self._pending = False
+        self._func(value)
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class RingBuffer:
+    def __init__(self, capacity):
+        assert capacity > 0, 'capacity must be positive'
+        self._buffer = array('d', [0.0]) * capacity
+        self._capacity = capacity
+        self._start = 0
+        self._size = 0
+
+    def append(self, value):
+        # Returns the value that fell out of the buffer, if any
+        end = (self._start + self._size) % self._capacity
+        if self._size < self._capacity:
+            self._buffer[end] = value
+            self._size = self._size + 1
+            return None
+        evicted = self._buffer[self._start]
+        self._buffer[self._start] = value
+        self._start = (self._start + 1) % self._capacity
+        return evicted
+
+    def clear(self):
+        self._start = 0
+        self._size = 0
+
+    def values(self):
+        end = self._start + self._size
+        if end <= self._capacity:
+            return self._buffer[self._start:end]
+        return self._buffer[self._start:] + self._buffer[:end - self._capacity]
+
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return self._size
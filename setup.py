@@ -18,9 +18,12 @@ setuptools.setup(
         "License :: OSI Approved :: GNU LGPLv3 License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.7',
     install_requires=[
-        'paho-mqtt>=1.4.0',
+        'paho-mqtt>=1.5.1',
         'PyYAML'
-    ]
+    ],
+    extras_require={
+        'orjson': ['orjson']
+    }
 )
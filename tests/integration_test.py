@@ -2,8 +2,8 @@ import logging
 from random import random
 
 from climate import Climate
-from components import create_func_result_cache, create_last_update_sensor, create_func_call_limiter, \
-    create_average_sensor, create_weighted_average_sensor
+from components import create_func_result_cache, create_last_update_sensor, create_average_sensor, \
+    create_weighted_average_sensor
 from mqtt import Mqtt, MqttSharedTopic
 from registry import ComponentRegistry
 from sensor import Sensor, ErrorSensor
@@ -14,13 +14,13 @@ def climate_state_change(mode, target):
     print('Climate state changed! mode {}, target {}'.format(mode, target))
 
 
-def create_temp_func(func_limiter, error_sensor):
+def create_temp_func(error_sensor):
     def _temp():
         if random() < 0.1:
             raise Exception("Fake exception")
         return random() * 100
 
-    return func_limiter.wrap(create_func_result_cache(error_sensor.wrap_function(_temp)))
+    return create_func_result_cache(error_sensor.wrap_function(_temp))
 
 
 def create_components(mqtt):
@@ -45,10 +45,8 @@ def create_components(mqtt):
     last_update = create_last_update_sensor('Last Update', **standard_config)
     registry.add_component(last_update)
 
-    func_limiter = create_func_call_limiter()
-
-    sen1 = Sensor('Temp 1', '°C', state_func=create_temp_func(func_limiter, errors), **standard_config)
-    sen2 = Sensor('Temp 2', '°C', state_func=create_temp_func(func_limiter, errors), **standard_config)
+    sen1 = Sensor('Temp 1', '°C', state_func=create_temp_func(errors), **standard_config)
+    sen2 = Sensor('Temp 2', '°C', state_func=create_temp_func(errors), **standard_config)
     registry.add_component(sen1)
     registry.add_component(sen2)
 
@@ -69,15 +67,14 @@ def create_components(mqtt):
     if not auto_discovery:
         logging.info("HA config:\n{}".format(registry.create_config()))
 
-    return registry, func_limiter
+    return registry
 
 
 if __name__ == "__main__":
     setup_logging()
     with Mqtt(mqtt_host='localhost') as mqtt:
-        registry, func_limiter = create_components(mqtt)
+        registry = create_components(mqtt)
         with registry:
             while True:
                 registry.send_updates()
                 sleep_for(1)
-                func_limiter.clear()
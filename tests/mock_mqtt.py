@@ -1,9 +1,12 @@
-from mqtt import Mqtt
+from mqtt import Mqtt, json_serializer
 
 
 class MockMqtt(Mqtt):
+    dispatches_on_event_loop = True  # Callbacks run wherever publish is called
+
     def __init__(self, test):
         self.test = test
+        self._serializer = json_serializer
         self._topics = {}
         self.messages = {}
         self.subscriptions = {}
@@ -14,12 +17,12 @@ class MockMqtt(Mqtt):
     def assert_messages(self, topic, l):
         self.test.assertEqual(l, self.get_published_messages(topic))
 
-    def subscribe(self, topic, func):
+    def subscribe(self, topic, func, broker_filter=None):
         subs = self.subscriptions.get(topic, [])
         subs.append(func)
         self.subscriptions[topic] = subs
 
-    def publish(self, topic, message):
+    def publish(self, topic, message, qos=0, retain=False):
         messages = self.messages.get(topic, [])
         messages.append(message)
         self.messages[topic] = messages
@@ -4,6 +4,7 @@ from climate import Climate
 from mqtt import MqttSharedTopic
 from registry import ComponentRegistry
 from tests.mock_mqtt import MockMqtt
+from util import sleep_for
 
 temp1 = 5.5
 temp2 = 5.5
@@ -124,3 +125,20 @@ class TestSwitch(TestCase):
         file.close()
 
         self.assertEqual(config, registry.create_config())
+
+    def test_coalesce_commands(self):
+        mqtt = MockMqtt(self)
+        changes = []
+
+        climate = Cli(mqtt=mqtt, thermometer=lambda: 20, state_change_func=lambda m, t: changes.append((m, t)),
+                      command_coalesce_window=0.05)
+
+        mqtt.publish('homeassistant/climate/test_name/cmdMode', 'heat')
+        for t in ['30', '35', '40']:
+            mqtt.publish('homeassistant/climate/test_name/cmdTargetTemp', t)
+        sleep_for(0.15)
+
+        self.assertEqual(True, climate.is_on())
+        self.assertEqual(2, len(changes))
+        self.assertEqual(('heat', 40.0), changes[-1])
+        mqtt.assert_messages('homeassistant/climate/test_name/stateTargetTemp', ['40.00'])
@@ -1,9 +1,17 @@
+import asyncio
+import itertools
+import threading
+import time
 from unittest import TestCase
 
+from climate import Climate
+from components import create_average_sensor
 from mqtt import MqttSharedTopic
 from registry import ComponentRegistry
-from sensor import ErrorSensor
+from sensor import ErrorSensor, Sensor, SettableSensor
+from switch import Switch
 from tests.mock_mqtt import MockMqtt
+from util import sleep_for
 
 
 class TestHa(TestCase):
@@ -71,3 +79,199 @@ class TestHa(TestCase):
         mqtt.assert_messages('homeassistant/sensor/error_1/state', ['0'])
         mqtt.assert_messages('homeassistant/sensor/error_2/state', ['0'])
         mqtt.assert_messages('/my/topic', [{'error_3': '0', 'error_4': '0'}])
+
+    def test_concurrent_updates(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry(workers=4, update_timeout=0.2, unavailable_on_timeout=True)
+
+        release = threading.Event()
+
+        def slow():
+            release.wait(5)
+            return 2
+
+        fast = Sensor('Fast', '', state_func=lambda: 1, mqtt=mqtt, auto_discovery=False)
+        stuck = Sensor('Stuck', '', state_func=slow, mqtt=mqtt, auto_discovery=False, availability_topic=True)
+        registry.add_component(fast)
+        registry.add_component(stuck)
+
+        registry.send_updates()
+        registry.send_updates()
+        release.set()
+        sleep_for(0.1)
+        registry.send_updates()
+        registry.__exit__()
+
+        mqtt.assert_messages('homeassistant/sensor/fast/state', ['1.00', '1.00', '1.00'])
+        mqtt.assert_messages('homeassistant/sensor/stuck/state', ['2.00', '2.00'])
+        mqtt.assert_messages('homeassistant/sensor/stuck/available', ['offline', 'online'])
+
+    def test_timed_out_shared_topic(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry(workers=4, update_timeout=0.2)
+        state = MqttSharedTopic(mqtt, "/my/topic")
+        release = threading.Event()
+        values = iter([1, 2])
+
+        def slow():
+            value = next(values)
+            if value == 2:
+                release.wait(2)
+            return value
+
+        registry.add_component(Sensor('Slow', '', state_func=slow, mqtt=mqtt, state_topic=state))
+        registry.add_shared_topic(state)
+
+        registry.send_updates()
+        started = time.monotonic()
+        registry.send_updates()
+        elapsed = time.monotonic() - started
+        release.set()
+        registry.__exit__()
+
+        self.assertLess(elapsed, 1)
+        mqtt.assert_messages('/my/topic', [{'slow': '1.00'}])
+
+    def test_run_intervals(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry()
+        state = MqttSharedTopic(mqtt, "/my/topic")
+
+        fast = Sensor('Fast', '', state_func=lambda: 1, mqtt=mqtt, auto_discovery=False)
+        slow = Sensor('Slow', '', state_func=lambda: 2, mqtt=mqtt, auto_discovery=False)
+        counter = itertools.count()
+        shared = Sensor('Shared', '', state_func=lambda: next(counter), mqtt=mqtt, auto_discovery=False,
+                        state_topic=state)
+        registry.add_component(fast, interval=0.05)
+        registry.add_component(slow, interval=10, phase=0.02)
+        registry.add_component(shared, send_updates=False)
+        registry.add_shared_topic(state, interval=0.1)
+
+        threading.Timer(0.28, registry.stop).start()
+        registry.run(interval=1)
+
+        self.assertIn(len(mqtt.get_published_messages('homeassistant/sensor/fast/state')), range(5, 8))
+        self.assertEqual(1, len(mqtt.get_published_messages('homeassistant/sensor/slow/state')))
+        self.assertIn(len(mqtt.get_published_messages('/my/topic')), range(2, 5))
+        self.assertLess(registry.get_max_loop_lag(), 0.05)
+
+    def test_stop_async(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry()
+        registry.add_component(Sensor('Slow', '', state_func=lambda: 2, mqtt=mqtt, auto_discovery=False),
+                               interval=600)
+
+        async def run():
+            asyncio.get_running_loop().call_later(0.05, registry.stop)
+            await registry.run_async(interval=600)
+
+        started = time.monotonic()
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(1, len(mqtt.get_published_messages('homeassistant/sensor/slow/state')))
+
+    def test_evaluated_once_per_cycle(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry()
+        state = MqttSharedTopic(mqtt, "/my/topic")
+        reads = []
+
+        def read():
+            reads.append(1)
+            return len(reads)
+
+        sensor = Sensor('S 1', '', state_func=read, mqtt=mqtt, state_topic=state)
+        avg = create_average_sensor('Avg', '', [sensor, sensor], mqtt=mqtt, state_topic=state)
+        climate = Climate('Boiler', sensor, mqtt=mqtt, state_topic=state)
+        registry.add_component([sensor, avg, climate])
+        registry.add_shared_topic(state)
+
+        registry.send_updates()
+        registry.send_updates()
+
+        self.assertEqual(3, len(reads))  # One read during construction of the climate, then one per cycle
+        mqtt.assert_messages('/my/topic', [{'s_1': '2.00', 'avg': '2.00', 'boiler_mode': 'off',
+                                            'boiler_curr_temp': '2.00', 'boiler_target_temp': '1.00'},
+                                           {'s_1': '3.00', 'avg': '3.00', 'boiler_mode': 'off',
+                                            'boiler_curr_temp': '3.00', 'boiler_target_temp': '1.00'}])
+
+    def test_command_during_cycle(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry()
+        release = threading.Event()
+        blocked = threading.Event()
+
+        def slow():
+            blocked.set()
+            release.wait(1)
+            return 1
+
+        settable = SettableSensor('W', '', 0, 100, 1, 10, mqtt=mqtt)
+        registry.add_component([settable, Sensor('Slow', '', state_func=slow, mqtt=mqtt)])
+
+        cycle = threading.Thread(target=registry.send_updates)
+        cycle.start()
+        blocked.wait(1)
+        settable._receive_command('50')
+        release.set()
+        cycle.join()
+
+        mqtt.assert_messages('homeassistant/sensor/w/state', ['10.00', '50.00'])
+
+    def test_overlapping_cycles(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry()
+
+        async def read():
+            await asyncio.sleep(0.01)
+            return 1
+
+        registry.add_component(Sensor('S 1', '', state_func=read, mqtt=mqtt))
+
+        async def run():
+            await asyncio.gather(registry.send_updates_async(), registry.send_updates_async())
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
+
+        mqtt.assert_messages('homeassistant/sensor/s_1/state', ['1.00', '1.00'])
+
+    def test_compact_discovery(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry(compact_discovery=True)
+        state = MqttSharedTopic(mqtt, "/my/topic")
+        sensor = ErrorSensor('Error 1', mqtt=mqtt, node_id='n', availability_topic=True)
+        switch = Switch('Switch 1', state_change_func=lambda s: None, mqtt=mqtt, state_topic=state)
+        registry.add_component([sensor, switch])
+
+        with registry:
+            pass
+
+        mqtt.assert_messages('homeassistant/sensor/n/error_1/config',
+                             [{'~': 'homeassistant/sensor/n/error_1',
+                               'ic': 'mdi:alarm-light',
+                               'name': 'Error 1',
+                               'stat_t': '~/state',
+                               'avty_t': '~/available',
+                               'pl_avail': 'online',
+                               'pl_not_avail': 'offline',
+                               'unit_of_meas': 'errors',
+                               'uniq_id': 'error_1'},
+                              None])
+        mqtt.assert_messages('homeassistant/switch/switch_1/config',
+                             [{'~': 'homeassistant/switch/switch_1',
+                               'name': 'Switch 1',
+                               'cmd_t': '~/cmd',
+                               'stat_t': '/my/topic',
+                               'val_tpl': '{{ value_json.switch_1 }}',
+                               'pl_on': 'on',
+                               'pl_off': 'off',
+                               'stat_on': 'on',
+                               'stat_off': 'off',
+                               'uniq_id': 'switch_1'},
+                              None])
+        self.assertEqual('homeassistant/sensor/n/error_1/state', sensor.get_config()['state_topic'])
@@ -0,0 +1,654 @@
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from mqtt import AsyncMqtt, Mqtt, MqttSharedTopic, ShardedMqtt, ShardedSharedTopic, TopicTrie, _KeyedExecutor, \
+    json_serializer, default_serializer, orjson, orjson_serializer
+from offline import OfflineQueue
+from registry import ComponentRegistry
+from sensor import Sensor, SettableSensor
+from switch import Switch
+from tests.mock_mqtt import MockMqtt
+from util import sleep_for
+
+
+class FakeResult:
+    def __init__(self, rc=0):
+        self.rc = rc
+        self.published = False
+
+    def is_published(self):
+        return self.published
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+        self.results = []
+        self.subscribed = []
+        self.rc = 0
+
+    def subscribe(self, topic, qos=0):
+        self.subscribed.append((topic, qos))
+
+    def unsubscribe(self, topic):
+        self.subscribed = [(t, qos) for t, qos in self.subscribed if t != topic]
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+        self.results.append(FakeResult(self.rc))
+        return self.results[-1]
+
+
+def create_mqtt(**kwargs):
+    mqtt = Mqtt(mqtt_host='localhost', **kwargs)
+    mqtt._mqtt_client = FakeClient()
+    return mqtt
+
+
+class TestPublishCache(TestCase):
+    def test_disabled(self):
+        mqtt = create_mqtt()
+
+        mqtt.publish('a', '1')
+        mqtt.publish('a', '1')
+
+        self.assertEqual([('a', '1'), ('a', '1')], mqtt._mqtt_client.published)
+        self.assertEqual(2, mqtt.get_published_count())
+        self.assertEqual(0, mqtt.get_suppressed_count())
+
+    def test_suppress_unchanged(self):
+        mqtt = create_mqtt(publish_cache=True, serializer=json_serializer)
+
+        mqtt.publish('a', '1')
+        mqtt.publish('a', '1')
+        mqtt.publish('b', '1')
+        mqtt.publish('a', '2')
+        mqtt.publish('a', {'x': 1})
+        mqtt.publish('a', {'x': 1})
+
+        self.assertEqual([('a', '1'), ('b', '1'), ('a', '2'), ('a', '{"x": 1}')], mqtt._mqtt_client.published)
+        self.assertEqual(4, mqtt.get_published_count())
+        self.assertEqual(2, mqtt.get_suppressed_count())
+
+    def test_interval(self):
+        mqtt = create_mqtt(publish_cache=True, publish_cache_interval=0.05)
+
+        mqtt.publish('a', '1')
+        mqtt.publish('a', '1')
+        sleep_for(0.1)
+        mqtt.publish('a', '1')
+
+        self.assertEqual([('a', '1'), ('a', '1')], mqtt._mqtt_client.published)
+        self.assertEqual(1, mqtt.get_suppressed_count())
+
+    def test_failed_publish_is_retried(self):
+        mqtt = create_mqtt(publish_cache=True)
+
+        mqtt._mqtt_client.rc = 4
+        mqtt.publish('a', '1')
+        mqtt._mqtt_client.rc = 0
+        mqtt.publish('a', '1')
+        mqtt.clear_publish_cache()
+        mqtt.publish('a', '1')
+
+        self.assertEqual([('a', '1'), ('a', '1'), ('a', '1')], mqtt._mqtt_client.published)
+        self.assertEqual(2, mqtt.get_published_count())
+
+
+class TestDiscovery(TestCase):
+    def test_wait_for_acknowledgement(self):
+        mqtt = create_mqtt()
+        registry = ComponentRegistry()
+        registry.add_component(Sensor('S 1', '', state_func=lambda: 1, mqtt=mqtt, availability_topic=True))
+        registry.add_component(Sensor('S 2', '', state_func=lambda: 2, mqtt=mqtt, availability_topic=True))
+
+        def acknowledge():
+            for r in mqtt._mqtt_client.results:
+                r.published = True
+
+        threading.Timer(0.1, acknowledge).start()
+        started = time.monotonic()
+        registry.__enter__()
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(['homeassistant/sensor/s_1/config',
+                          'homeassistant/sensor/s_2/config',
+                          'homeassistant/sensor/s_1/available',
+                          'homeassistant/sensor/s_2/available'], [t for t, _ in mqtt._mqtt_client.published])
+
+    def test_timeout(self):
+        mqtt = create_mqtt()
+        registry = ComponentRegistry(discovery_timeout=0.05)
+        registry.add_component(Sensor('S 1', '', state_func=lambda: 1, mqtt=mqtt, availability_topic=True))
+
+        registry.__enter__()
+
+        self.assertEqual(['homeassistant/sensor/s_1/config',
+                          'homeassistant/sensor/s_1/available'], [t for t, _ in mqtt._mqtt_client.published])
+
+
+class TestSerializer(TestCase):
+    def test_default(self):
+        self.assertEqual(orjson_serializer if orjson is not None else json_serializer, default_serializer())
+
+    def test_discovery_serialized_once(self):
+        calls = []
+
+        def serializer(message):
+            calls.append(message)
+            return json_serializer(message)
+
+        mqtt = create_mqtt(serializer=serializer)
+        sensor = Sensor('S 1', '', state_func=lambda: 1, mqtt=mqtt)
+
+        sensor.__enter__()
+        sensor.__enter__()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(mqtt._mqtt_client.published[0], mqtt._mqtt_client.published[1])
+        self.assertEqual(('homeassistant/sensor/s_1/config',
+                          '{"unique_id": "s_1", "name": "S 1", "unit_of_measurement": "", '
+                          '"state_topic": "homeassistant/sensor/s_1/state"}'), mqtt._mqtt_client.published[0])
+
+
+class TestTopicTrie(TestCase):
+    def test_match(self):
+        trie = TopicTrie()
+        for f in ['a/b/c', 'a/+/c', 'a/#', '+/+/+', '#', 'a/b', '+/b/#']:
+            trie.add(f, f)
+
+        self.assertEqual(['a/b/c', 'a/+/c', 'a/#', '+/b/#', '+/+/+', '#'], trie.match('a/b/c'))
+        self.assertEqual(['a/b', 'a/#', '+/b/#', '#'], trie.match('a/b'))
+        self.assertEqual(['a/#', '#'], trie.match('a'))
+        self.assertEqual(['+/+/+', '#'], trie.match('x/y/z'))
+        self.assertEqual([], trie.match('$SYS/y/z'))
+
+    def test_add_remove(self):
+        trie = TopicTrie()
+        f1 = lambda: 1
+        f2 = lambda: 2
+
+        self.assertTrue(trie.add('a/+', f1))
+        self.assertFalse(trie.add('a/+', f2))
+        self.assertEqual([f1, f2], trie.match('a/b'))
+        self.assertEqual(['a/+'], trie.filters())
+
+        self.assertFalse(trie.remove('a/+', f1))
+        self.assertFalse(trie.remove('a/+', f1))
+        self.assertTrue(trie.remove('a/+', f2))
+        self.assertEqual([], trie.match('a/b'))
+        self.assertEqual([], trie.filters())
+
+    def test_dispatch(self):
+        mqtt = create_mqtt()
+        received = []
+
+        mqtt.subscribe('a/+/c', lambda m: received.append(('+', m)))
+        mqtt.subscribe('a/#', lambda m: received.append(('#', m)))
+        mqtt.subscribe('a/#', lambda m: received.append(('#2', m)))
+        mqtt._on_message(None, None, FakeMessage('a/b/c', b'1'))
+        mqtt._on_message(None, None, FakeMessage('b/b/c', b'2'))
+
+        self.assertEqual([('a/+/c', 0), ('a/#', 0)], mqtt._mqtt_client.subscribed)
+        self.assertEqual([('+', '1'), ('#', '1'), ('#2', '1')], received)
+
+    def test_node_subscription(self):
+        mqtt = create_mqtt()
+        received = []
+
+        def create_switch(name, node_id):
+            return Switch(name, state_change_func=lambda s: received.append((name, s)), mqtt=mqtt, node_id=node_id)
+
+        create_switch('Switch 1', 'node')
+        create_switch('Switch 2', 'node')
+        create_switch('Switch 3', None)
+        SettableSensor('Sensor 1', '', 0, 10, 1, 5, mqtt=mqtt, node_id='node')
+
+        mqtt._on_message(None, None, FakeMessage('homeassistant/switch/node/switch_2/cmd', b'on'))
+        mqtt._on_message(None, None, FakeMessage('homeassistant/switch/switch_3/cmd', b'on'))
+        mqtt._on_message(None, None, FakeMessage('homeassistant/switch/node/switch_4/cmd', b'on'))
+
+        self.assertEqual([('homeassistant/+/node/+/cmd', 0), ('homeassistant/switch/switch_3/cmd', 0)],
+                         mqtt._mqtt_client.subscribed)
+        self.assertEqual([('Switch 2', True), ('Switch 3', True)], received)
+
+
+class TestDispatch(TestCase):
+    def test_ordered_per_entity(self):
+        mqtt = create_mqtt(dispatch_workers=2)
+        mqtt._dispatcher = _KeyedExecutor(2)
+        received = []
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def slow(m):
+            release.wait(5)
+            with lock:
+                received.append(('a', m))
+
+        def fast(m):
+            with lock:
+                received.append(('b', m))
+
+        mqtt.subscribe('a/cmd', slow)
+        mqtt.subscribe('b/cmd', fast)
+        for i in range(3):
+            mqtt._on_message(None, None, FakeMessage('a/cmd', str(i).encode()))
+        mqtt._on_message(None, None, FakeMessage('b/cmd', b'x'))
+        sleep_for(0.1)
+        release.set()
+        mqtt._dispatcher.shutdown()
+
+        self.assertEqual([('b', 'x'), ('a', '0'), ('a', '1'), ('a', '2')], received)
+
+
+class TestSharedTopic(TestCase):
+    def test_skip_unchanged(self):
+        mqtt = create_mqtt(serializer=json_serializer)
+        values = {'a': 1, 'b': 'x'}
+        state = MqttSharedTopic(mqtt, 'shared')
+        state.add_entry('a', lambda: values['a'])
+        state.add_entry('b', lambda: values['b'])
+
+        state.publish()
+        state.publish()
+        values['a'] = 2
+        state.publish()
+
+        self.assertEqual([('shared', '{"a": 1, "b": "x"}'), ('shared', '{"a": 2, "b": "x"}')],
+                         mqtt._mqtt_client.published)
+
+    def test_keepalive(self):
+        mqtt = create_mqtt(serializer=json_serializer)
+        state = MqttSharedTopic(mqtt, 'shared', keepalive_interval=0.05)
+        state.add_entry('a', lambda: 1)
+
+        state.publish()
+        state.publish()
+        sleep_for(0.1)
+        state.publish()
+
+        self.assertEqual([('shared', '{"a": 1}'), ('shared', '{"a": 1}')], mqtt._mqtt_client.published)
+
+    def test_none_omitted(self):
+        mqtt = create_mqtt(serializer=json_serializer)
+        values = {'a': None, 'b': None}
+        state = MqttSharedTopic(mqtt, 'shared')
+        state.add_entry('a', lambda: values['a'])
+        state.add_entry('b', lambda: values['b'])
+
+        state.publish()
+        values['b'] = 2
+        state.publish()
+        values['a'] = 1
+        values['b'] = None
+        state.publish()
+
+        self.assertEqual([('shared', '{"b": 2}'), ('shared', '{"a": 1, "b": 2}')], mqtt._mqtt_client.published)
+
+    def test_serializer(self):
+        mqtt = create_mqtt(serializer=lambda m: json_serializer(m).replace(' ', '').encode('utf-8'))
+        state = MqttSharedTopic(mqtt, 'shared')
+        state.add_entry('a', lambda: 1)
+        state.add_entry('b', lambda: 'x y')
+
+        state.publish()
+
+        self.assertEqual([('shared', b'{"a": 1, "b": "xy"}')], mqtt._mqtt_client.published)
+
+    def test_sharded(self):
+        mqtt = MockMqtt(self)
+        state = ShardedSharedTopic(mqtt, 'shared', max_entries=2)
+
+        sensors = [Sensor('S {}'.format(i), '', state_func=lambda: 1, mqtt=mqtt, state_topic=state) for i in range(3)]
+        switch = Switch('Sw', state_change_func=lambda s: None, mqtt=mqtt, state_topic=state)
+        state.publish()
+
+        self.assertEqual(['shared/0', 'shared/0', 'shared/1'], [s.get_config()['state_topic'] for s in sensors])
+        self.assertEqual('shared/1', switch.get_config()['state_topic'])
+        self.assertEqual('{{ value_json.sw }}', switch.get_config()['value_template'])
+        mqtt.assert_messages('shared/0', [{'s_0': '1.00', 's_1': '1.00'}])
+        mqtt.assert_messages('shared/1', [{'s_2': '1.00', 'sw': 'off'}])
+
+    def test_sharded_bytes(self):
+        mqtt = MockMqtt(self)
+        state = ShardedSharedTopic(mqtt, 'shared', max_bytes=70, value_size=10)
+
+        topics = [state.add_topic_entry('key_{}'.format(i), lambda: 1)[0] for i in range(5)]
+
+        self.assertEqual(['shared/0', 'shared/0', 'shared/0', 'shared/1', 'shared/1'], topics)
+
+
+class TestShardedMqtt(TestCase):
+    def test_instances_do_not_share_subscriptions(self):
+        mqtt1 = create_mqtt()
+        mqtt2 = create_mqtt()
+        received = []
+
+        mqtt1.subscribe('a', lambda m: received.append(m))
+        mqtt2._on_message(None, None, FakeMessage('a', b'1'))
+
+        self.assertEqual([], received)
+        self.assertEqual([], mqtt2._mqtt_client.subscribed)
+
+    def test_offline_queue_per_shard(self):
+        with tempfile.TemporaryDirectory() as d:
+            with self.assertRaises(AssertionError):
+                ShardedMqtt(shards=2, mqtt_host='localhost', offline_queue=OfflineQueue(os.path.join(d, 'q')))
+
+            mqtt = ShardedMqtt(shards=2, mqtt_host='localhost',
+                               offline_queue_factory=lambda i: OfflineQueue(os.path.join(d, 'q{}'.format(i))))
+            queues = [shard._offline_queue for shard in mqtt.shards()]
+            self.assertIsNot(queues[0], queues[1])
+            for q in queues:
+                q.close()
+
+    def test_client_id_per_shard(self):
+        mqtt = ShardedMqtt(shards=2, mqtt_host='localhost', client_id='node')
+        self.assertEqual([b'node-0', b'node-1'], [shard._mqtt_client._client_id for shard in mqtt.shards()])
+        self.assertFalse(mqtt.shards()[0]._clean_session)
+
+    def test_spread(self):
+        mqtt = ShardedMqtt(shards=3, mqtt_host='localhost')
+        for shard in mqtt.shards():
+            shard._mqtt_client = FakeClient()
+        received = []
+
+        for i in range(30):
+            mqtt.publish('homeassistant/sensor/s_{}/config'.format(i), '')
+            mqtt.publish('homeassistant/sensor/s_{}/state'.format(i), '1')
+        mqtt.subscribe('homeassistant/switch/sw/cmd', lambda m: received.append(m))
+        for shard in mqtt.shards():
+            shard._on_message(None, None, FakeMessage('homeassistant/switch/sw/cmd', b'on'))
+
+        for shard in mqtt.shards():
+            published = shard._mqtt_client.published
+            self.assertGreater(len(published), 0)
+            self.assertEqual([t.replace('/config', '/state') for t, _ in published[0::2]],
+                             [t for t, _ in published[1::2]])
+        self.assertEqual(60, mqtt.get_published_count())
+        self.assertEqual(['on'], received)
+
+
+class TestOfflineQueue(TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'queue')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_newest_value_per_topic(self):
+        queue = OfflineQueue(self._path)
+        queue.put('a', '1')
+        queue.put('b', '1', qos=1, retain=True)
+        queue.put('a', '2')
+
+        self.assertEqual(2, len(queue))
+        self.assertEqual(('b', b'1', 1, True), queue.pop())
+        self.assertEqual(('a', b'2', 0, False), queue.pop())
+        self.assertIsNone(queue.pop())
+        queue.close()
+
+    def test_reload(self):
+        queue = OfflineQueue(self._path, max_messages=2)
+        queue.put('a', '1')
+        queue.put('b', '1')
+        queue.put('c', '1')
+        queue.close()
+        with open(self._path, 'a') as f:
+            f.write('{corrupt\n')
+
+        queue = OfflineQueue(self._path, max_messages=2)
+        self.assertEqual(2, len(queue))
+        self.assertEqual('b', queue.pop()[0])
+        self.assertEqual('c', queue.pop()[0])
+        queue.close()
+        self.assertEqual(0, os.path.getsize(self._path))
+
+    def test_replay_on_connect(self):
+        queue = OfflineQueue(self._path, replay_rate=1000)
+        mqtt = create_mqtt(offline_queue=queue)
+
+        self.assertIsNotNone(mqtt.publish('s', '1'))
+        mqtt._on_connect(None, None, {}, 0)
+        mqtt._on_disconnect(None, None, 1)
+
+        self.assertIsNone(mqtt.publish('a', '1'))
+        mqtt.publish('b', {'x': 1})
+        mqtt.publish('a', '2')
+        self.assertEqual(['s'], [t for t, _ in mqtt._mqtt_client.published])
+
+        mqtt._on_connect(None, None, {}, 0)
+        deadline = time.monotonic() + 1
+        while len(queue) > 0 or mqtt._replaying:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        mqtt.publish('c', '1')
+
+        published = mqtt._mqtt_client.published
+        self.assertEqual(['s', 'b', 'a', 'c'], [t for t, _ in published])
+        self.assertEqual(b'2', published[2][1])
+
+        mqtt._on_disconnect(None, None, 1)
+        mqtt.publish('d', '1')
+        self.assertEqual(1, len(queue))
+        queue.close()
+
+    def test_live_publish_drops_queued(self):
+        queue = OfflineQueue(self._path)
+        mqtt = create_mqtt(offline_queue=queue)
+        mqtt._on_connect(None, None, {}, 0)
+        mqtt._on_disconnect(None, None, 1)
+        mqtt.publish('a', '1')
+        mqtt.publish('b', '1')
+
+        mqtt._connected = True
+        mqtt.publish('a', '2')
+
+        self.assertEqual([('a', '2')], mqtt._mqtt_client.published)
+        self.assertEqual(1, len(queue))
+        queue.close()
+        queue = OfflineQueue(self._path)
+        self.assertEqual([('b', b'1', 0, False), None], [queue.pop(), queue.pop()])
+        queue.close()
+
+    def test_failed_publish_queued(self):
+        queue = OfflineQueue(self._path)
+        mqtt = create_mqtt(offline_queue=queue)
+        mqtt._connected = True
+        mqtt._mqtt_client.rc = 4
+
+        mqtt.publish('a', '1')
+
+        self.assertEqual(('a', b'1', 0, False), queue.pop())
+        queue.close()
+
+
+class TestReconnect(TestCase):
+    def test_resubscribe_without_session(self):
+        mqtt = create_mqtt()
+        mqtt._on_connect(None, None, {}, 0)
+        mqtt.subscribe('a', lambda m: None)
+        mqtt.subscribe('b', lambda m: None)
+
+        mqtt._on_connect(None, None, {'session present': 1}, 0)
+        self.assertEqual([('a', 0), ('b', 0)], mqtt._mqtt_client.subscribed)
+
+        mqtt._on_connect(None, None, {'session present': 0}, 0)
+        self.assertEqual(([('a', 0), ('b', 0)], 0), mqtt._mqtt_client.subscribed[-1])
+
+    def test_persistent_session(self):
+        mqtt = create_mqtt(client_id='node')
+        mqtt.subscribe('a', lambda m: None)
+
+        self.assertEqual([('a', 1)], mqtt._mqtt_client.subscribed)
+
+    def test_refused_only_fatal_on_first_connect(self):
+        mqtt = create_mqtt()
+        with self.assertRaises(SystemExit):
+            mqtt._on_connect(None, None, {}, 5)
+
+        mqtt._on_connect(None, None, {}, 0)
+        mqtt._on_connect(None, None, {}, 5)
+
+    def test_reannounce(self):
+        mqtt = create_mqtt(publish_cache=True)
+        mqtt._on_connect(None, None, {}, 0)
+        registry = ComponentRegistry(mqtt=mqtt, announce_rate=None, discovery_timeout=0)
+        sensor = Sensor('S 1', '', state_func=lambda: 1, mqtt=mqtt, availability_topic=True)
+        registry.add_component(sensor)
+        registry.add_component(Switch('Sw 1', state_change_func=lambda s: None, mqtt=mqtt), send_updates=False)
+
+        with registry:
+            registry.send_updates()
+            mqtt._mqtt_client.published.clear()
+
+            mqtt._on_connect(None, None, {'session present': 1}, 0)
+            self.assertEqual(['homeassistant/sensor/s_1/available', 'homeassistant/sensor/s_1/state'],
+                             [t for t, _ in mqtt._mqtt_client.published])
+
+            mqtt._mqtt_client.published.clear()
+            mqtt._on_connect(None, None, {'session present': 0}, 0)
+            self.assertEqual(['homeassistant/sensor/s_1/config', 'homeassistant/sensor/s_1/available',
+                              'homeassistant/sensor/s_1/state', 'homeassistant/switch/sw_1/config'],
+                             [t for t, _ in mqtt._mqtt_client.published])
+            self.assertEqual(4, registry.get_announced_count())
+
+    def test_reannounce_rate_limited(self):
+        mqtt = create_mqtt()
+        mqtt._on_connect(None, None, {}, 0)
+        registry = ComponentRegistry(mqtt=mqtt, announce_rate=30, discovery_timeout=0)
+        for i in range(10):
+            registry.add_component(Sensor('S {}'.format(i), '', state_func=lambda: 1, mqtt=mqtt))
+
+        with registry:
+            started = time.monotonic()
+            mqtt._on_connect(None, None, {}, 0)
+            while registry.get_announced_count() < 10:
+                self.assertLess(time.monotonic() - started, 2)
+                time.sleep(0.01)
+
+            self.assertGreaterEqual(time.monotonic() - started, 0.25)  # 4 batches of 3
+
+
+class TestBirthMessage(TestCase):
+    def test_online_offline(self):
+        mqtt = create_mqtt()
+        registry = ComponentRegistry(mqtt=mqtt, announce_rate=None, discovery_timeout=0)
+        registry.add_component(Sensor('S 1', '', state_func=lambda: 1, mqtt=mqtt))
+
+        with registry:
+            self.assertIn(('homeassistant/status', 0), mqtt._mqtt_client.subscribed)
+            mqtt._mqtt_client.published.clear()
+
+            mqtt._on_message(None, None, FakeMessage('homeassistant/status', b'offline'))
+            registry.send_updates()
+            self.assertTrue(registry.is_paused())
+            self.assertEqual([], mqtt._mqtt_client.published)
+
+            mqtt._on_message(None, None, FakeMessage('homeassistant/status', b'online'))
+            self.assertFalse(registry.is_paused())
+            self.assertEqual(['homeassistant/sensor/s_1/config', 'homeassistant/sensor/s_1/state'],
+                             [t for t, _ in mqtt._mqtt_client.published])
+
+            registry.send_updates()
+            self.assertEqual(3, len(mqtt._mqtt_client.published))
+
+    def test_online_bypasses_caches_and_filters(self):
+        mqtt = create_mqtt(publish_cache=True)
+        registry = ComponentRegistry(mqtt=mqtt, announce_rate=None, discovery_timeout=0)
+        registry.add_component(Sensor('S 1', '', state_func=lambda: 1, mqtt=mqtt, availability_topic=True,
+                                      deadband=5, min_interval=60))
+
+        with registry:
+            registry.send_updates()
+            registry.send_updates()
+            mqtt._mqtt_client.published.clear()
+
+            mqtt._on_message(None, None, FakeMessage('homeassistant/status', b'online'))
+            self.assertEqual(['homeassistant/sensor/s_1/config', 'homeassistant/sensor/s_1/available',
+                              'homeassistant/sensor/s_1/state'], [t for t, _ in mqtt._mqtt_client.published])
+
+
+class TestRetainedDiscovery(TestCase):
+    def test_diff(self):
+        mqtt = create_mqtt(serializer=json_serializer)
+        registry = ComponentRegistry(mqtt=mqtt, announce_rate=None, discovery_timeout=0.5, retain_discovery=True,
+                                     retained_quiet=0.1)
+        sensors = [Sensor('S {}'.format(i), 'C', state_func=lambda: 1, mqtt=mqtt, node_id='n') for i in [1, 2, 4]]
+        registry.add_component(sensors)
+
+        unchanged = dict(reversed(list(sensors[0].get_config().items())))
+        changed = dict(sensors[1].get_config(), unit_of_measurement='F')
+
+        def deliver():
+            for topic, config in [('homeassistant/sensor/n/s_1/config', unchanged),
+                                  ('homeassistant/sensor/n/s_2/config', changed),
+                                  ('homeassistant/sensor/n/s_3/config', {'unique_id': 's_3'}),
+                                  ('homeassistant/sensor/n/s_5/config', None)]:
+                payload = json_serializer(config).encode('utf-8') if config is not None else b''
+                mqtt._on_message(None, None, FakeMessage(topic, payload))
+
+        threading.Timer(0.02, deliver).start()
+        with registry:
+            self.assertEqual([('homeassistant/sensor/n/s_3/config', ''),
+                              ('homeassistant/sensor/n/s_2/config', json_serializer(sensors[1].get_config())),
+                              ('homeassistant/sensor/n/s_4/config', json_serializer(sensors[2].get_config()))],
+                             [(t, p) for t, p in mqtt._mqtt_client.published if t.endswith('/config')])
+            self.assertEqual([('homeassistant/status', 0)], mqtt._mqtt_client.subscribed)
+            self.assertEqual(['homeassistant/status'], mqtt._mqtt_subs.filters())
+
+        self.assertEqual(3, len([t for t, _ in mqtt._mqtt_client.published if t.endswith('/config')]))
+
+
+class ReconnectingClient(FakeClient):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.reconnects = 0
+
+    def reconnect(self):
+        self.reconnects = self.reconnects + 1
+        if self.reconnects <= self.failures:
+            raise ConnectionRefusedError()
+
+
+class TestAsyncReconnect(TestCase):
+    def test_reconnect_with_backoff(self):
+        mqtt = AsyncMqtt(mqtt_host='localhost')
+        mqtt._mqtt_client = ReconnectingClient(2)
+        mqtt.RECONNECT_MIN_DELAY = 0.01
+        sock, other = socket.socketpair()
+
+        async def run():
+            mqtt._loop = asyncio.get_event_loop()
+            mqtt._on_socket_close(mqtt._mqtt_client, None, sock)
+            await mqtt._reconnect_task
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
+        sock.close()
+        other.close()
+
+        self.assertEqual(3, mqtt._mqtt_client.reconnects)
+
+    def test_coroutine_command_needs_async_mqtt(self):
+        async def change(state):
+            pass
+
+        with self.assertRaises(AssertionError):
+            Switch('Sw 1', state_change_func=change, mqtt=create_mqtt())
+        Switch('Sw 1', state_change_func=change, mqtt=AsyncMqtt(mqtt_host='localhost'))
@@ -1,10 +1,16 @@
+import asyncio
+import itertools
+import statistics
+import threading
 from unittest import TestCase
 
-from components import create_average_sensor, create_weighted_average_sensor
+from components import create_average_sensor, create_weighted_average_sensor, create_aggregate_sensor, \
+    create_window_sensor, create_ttl_cache, create_func_call_limiter, create_circuit_breaker_sensors
 from mqtt import MqttSharedTopic
 from registry import ComponentRegistry
-from sensor import Sensor, SettableSensor, ErrorSensor
+from sensor import Sensor, SettableSensor, ErrorSensor, OversamplingSensor, CircuitBreaker
 from tests.mock_mqtt import MockMqtt
+from util import sleep_for
 
 
 class Sen(Sensor):
@@ -59,6 +65,71 @@ class TestSensor(TestCase):
         mqtt.assert_messages('/my/topic', [{"test_name": "1.24"}])
         mqtt.assert_messages('homeassistant/sensor/test_name/available', ["online"])
 
+    def test_deadband(self):
+        mqtt = MockMqtt(self)
+        values = iter([10, 10.5, 11.5, 11.6, 20, 20.5, 25])
+
+        sensor = Sen(mqtt=mqtt, state_func=lambda: next(values), deadband=1)
+        percent = Sen(name='Percent', mqtt=mqtt, state_func=lambda: next(values), deadband_percent=10)
+
+        for _ in range(4):
+            sensor.send_update()
+        for _ in range(3):
+            percent.send_update()
+
+        mqtt.assert_messages('homeassistant/sensor/test_name/state', ['10.00', '11.50'])
+        mqtt.assert_messages('homeassistant/sensor/percent/state', ['20.00', '25.00'])
+
+    def test_intervals(self):
+        mqtt = MockMqtt(self)
+        values = iter([1, 2, 3, 3, 3])
+
+        sensor = Sen(mqtt=mqtt, state_func=lambda: next(values), deadband=0, min_interval=0.05, max_interval=0.2)
+
+        sensor.send_update()
+        sensor.send_update()
+        sleep_for(0.1)
+        sensor.send_update()
+        sensor.send_update()
+        sleep_for(0.2)
+        sensor.send_update()
+
+        mqtt.assert_messages('homeassistant/sensor/test_name/state', ['1.00', '3.00', '3.00'])
+
+    def test_oversampling(self):
+        mqtt = MockMqtt(self)
+        signal = itertools.cycle([1, -1])
+
+        rms = OversamplingSensor('Rms', 'A', state_func=lambda: next(signal), sample_rate=500, reduce='rms',
+                                 mqtt=mqtt, auto_discovery=False)
+        mean = OversamplingSensor('Mean', 'A', state_func=lambda: 2, sample_rate=500, mqtt=mqtt,
+                                  auto_discovery=False)
+
+        with rms, mean:
+            sleep_for(0.05)
+            rms.send_update()
+            mean.send_update()
+            rms.send_update()
+
+        self.assertIsNone(rms._sampler)
+        mqtt.assert_messages('homeassistant/sensor/rms/state', ['1.00', '1.00'])
+        mqtt.assert_messages('homeassistant/sensor/mean/state', ['2.00'])
+
+    def test_oversampling_bad_samples(self):
+        mqtt = MockMqtt(self)
+        signal = iter(['x', 'y'])
+
+        sensor = OversamplingSensor('Bad', 'A', state_func=lambda: next(signal, 3), sample_rate=500, mqtt=mqtt,
+                                    auto_discovery=False)
+        sensor.send_update()
+
+        with sensor:
+            sleep_for(0.05)
+            self.assertTrue(sensor._sampler.is_alive())
+            sensor.send_update()
+
+        mqtt.assert_messages('homeassistant/sensor/bad/state', ['3.00'])
+
 
 class SetSen(SettableSensor):
     def __init__(self, name='Test Name', **kwargs):
@@ -135,6 +206,22 @@ class TestSettableSensor(TestCase):
 
         self.assertEqual(config, registry.create_config())
 
+    def test_coalesce_commands(self):
+        mqtt = MockMqtt(self)
+        changes = []
+
+        sensor = SetSen(mqtt=mqtt, state_change_func=lambda s: changes.append(s), command_coalesce_window=0.05)
+
+        for v in ['1', '2', '3']:
+            mqtt.publish('homeassistant/sensor/test_name/cmd', v)
+        sleep_for(0.15)
+        mqtt.publish('homeassistant/sensor/test_name/cmd', '4')
+        sleep_for(0.15)
+
+        self.assertEqual([3.0, 4.0], changes)
+        self.assertEqual(4.0, sensor())
+        mqtt.assert_messages('homeassistant/sensor/test_name/state', ['3.00', '4.00'])
+
 
 class TestUtil(TestCase):
     def test_average(self):
@@ -229,3 +316,186 @@ class TestUtil(TestCase):
         mqtt.assert_messages('homeassistant/sensor/s_1_weight/state', ['50.00', '20.00', '20.00'])
         mqtt.assert_messages('homeassistant/sensor/s_2_weight/state', ['50.00', '40.00', '40.00'])
         mqtt.assert_messages('homeassistant/sensor/s_3_weight/state', ['50.00', '80.00', '80.00'])
+
+    def test_aggregate(self):
+        mqtt = MockMqtt(self)
+        values = [1, 4, 7]
+        calls = []
+
+        def create_func(i):
+            def _f():
+                calls.append(i)
+                return values[i]
+
+            return _f
+
+        sensors = [Sen(name='S {}'.format(i), mqtt=mqtt, state_func=create_func(i)) for i in range(3)]
+        weights = [SettableSensor('W {}'.format(i), '', 0, 100, 1, 50, mqtt=mqtt) for i in range(3)]
+        aggregates = {a: create_aggregate_sensor(a, '', sensors, aggregate=a, mqtt=mqtt)
+                      for a in ['sum', 'mean', 'min', 'max']}
+        aggregates['weighted_mean'] = create_aggregate_sensor('weighted_mean', '', sensors, aggregate='weighted_mean',
+                                                              weights=weights, mqtt=mqtt)
+
+        self.assertEqual({'sum': 12, 'mean': 4, 'min': 1, 'max': 7, 'weighted_mean': 4},
+                         {a: s() for a, s in aggregates.items()})
+        self.assertEqual([0, 1, 2], calls)
+
+        values[2] = 0
+        sensors[2]()
+        mqtt.publish('homeassistant/sensor/w_0/cmd', '100')
+
+        self.assertEqual({'sum': 5, 'mean': 5 / 3, 'min': 0, 'max': 4, 'weighted_mean': 1.5},
+                         {a: s() for a, s in aggregates.items()})
+        self.assertEqual([0, 1, 2, 2], calls)
+
+    def test_window(self):
+        mqtt = MockMqtt(self)
+        samples = [3, 1, 4, 1, 5, 9, 2, 6]
+        results = {}
+
+        for stat in ['mean', 'sum', 'min', 'max', 'stddev', 'median']:
+            source = iter(samples)
+            sensor = create_window_sensor(stat, '', lambda: next(source), window=4, stat=stat, mqtt=mqtt)
+            results[stat] = [sensor() for _ in samples]
+        source = iter(samples)
+        sensor = create_window_sensor('p75', '', lambda: next(source), window=4, stat='percentile', percentile=75,
+                                      mqtt=mqtt)
+        results['p75'] = [sensor() for _ in samples]
+
+        self.assertEqual([3, 2, 8 / 3, 2.25, 2.75, 4.75, 4.25, 5.5], results['mean'])
+        self.assertEqual([3, 4, 8, 9, 11, 19, 17, 22], results['sum'])
+        self.assertEqual([3, 1, 1, 1, 1, 1, 1, 2], results['min'])
+        self.assertEqual([3, 3, 4, 4, 5, 9, 9, 9], results['max'])
+        self.assertEqual([3, 2, 3, 2, 2.5, 4.5, 3.5, 5.5], results['median'])
+        self.assertEqual([3, 2.5, 3.5, 3.25, 4.25, 6, 6, 6.75], results['p75'])
+        self.assertAlmostEqual(1.0, results['stddev'][1])
+        self.assertAlmostEqual(statistics.pstdev(samples[-4:]), results['stddev'][-1])
+
+    def test_window_without_samples(self):
+        mqtt = MockMqtt(self)
+        values = [None, 2]
+        sensor = create_window_sensor('w', '', lambda: values.pop(0), mqtt=mqtt)
+
+        sensor.send_update()
+        sensor.send_update()
+
+        mqtt.assert_messages('homeassistant/sensor/w/state', ['2.00'])
+
+    def test_ttl_cache(self):
+        cache = create_ttl_cache(max_size=2)
+        counter = itertools.count()
+        refreshed = threading.Event()
+
+        def read():
+            value = next(counter)
+            if value > 0:
+                refreshed.set()
+            return value
+
+        cached = cache.wrap(read, ttl=0.05)
+
+        self.assertEqual([0, 0], [cached(), cached()])
+        sleep_for(0.1)
+        self.assertEqual(0, cached())  # Stale value, refreshed in the background
+        refreshed.wait(1)
+        sleep_for(0.01)
+        self.assertEqual(1, cached())
+
+        blocking = cache.wrap(lambda x: x * 2, ttl=10)
+        self.assertEqual([2, 4, 2], [blocking(1), blocking(2), blocking(1)])
+        self.assertEqual({'hits': 3, 'misses': 3, 'stale_hits': 1, 'refreshes': 1, 'refresh_errors': 0,
+                          'evictions': 1, 'size': 2}, cache.stats())
+
+    def test_func_call_limiter(self):
+        limiter = create_func_call_limiter()
+        counter = itertools.count()
+        limited = limiter.wrap(lambda: next(counter))
+
+        self.assertEqual([0, 0], [limited(), limited()])
+        limiter.clear()
+        self.assertEqual([1, 1], [limited(), limited()])
+
+    def test_circuit_breaker(self):
+        mqtt = MockMqtt(self)
+        calls = []
+        failing = [True]
+
+        def read():
+            calls.append(1)
+            if failing[0]:
+                raise Exception('Fake exception')
+            return 5
+
+        errors = ErrorSensor('Errors', mqtt=mqtt)
+        breaker = CircuitBreaker(failure_threshold=2, backoff=0.05, max_backoff=1)
+        sensor = Sen(mqtt=mqtt, state_func=errors.wrap_function(read, breaker), availability_topic=True)
+        breaker.add_component(sensor)
+        state, trips = create_circuit_breaker_sensors('Breaker', breaker, mqtt=mqtt)
+
+        self.assertEqual([None, None, None, None], [sensor() for _ in range(4)])
+        self.assertEqual((2, 2, 'open', 1), (len(calls), errors(), state(), trips()))
+        sleep_for(0.07)
+        self.assertEqual(None, sensor())  # Probe fails, backoff doubles
+        self.assertEqual(None, sensor())
+        sleep_for(0.07)
+        self.assertEqual(None, sensor())
+        self.assertEqual(3, len(calls))
+        sleep_for(0.05)
+        failing[0] = False
+        self.assertEqual(5, sensor())
+        self.assertEqual((4, 3, 'closed', 1), (len(calls), errors(), state(), trips()))
+        mqtt.assert_messages('homeassistant/sensor/test_name/available', ['offline', 'online'])
+
+    def test_circuit_breaker_holds_availability(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry(announce_rate=None)
+
+        def read():
+            raise Exception('Fake exception')
+
+        breaker = CircuitBreaker(failure_threshold=1, backoff=60)
+        sensor = Sen(mqtt=mqtt, state_func=breaker.wrap(read), availability_topic=True, auto_discovery=False)
+        breaker.add_component(sensor)
+        registry.add_component(sensor)
+
+        sensor()
+        registry._on_reconnect(True)
+
+        self.assertTrue(sensor.is_unavailable_held())
+        mqtt.assert_messages('homeassistant/sensor/test_name/available', ['offline', 'offline'])
+
+
+class TestAsync(TestCase):
+    def test_async_state_func(self):
+        mqtt = MockMqtt(self)
+        registry = ComponentRegistry()
+        state = MqttSharedTopic(mqtt, "/my/topic")
+        changes = []
+
+        async def read():
+            await asyncio.sleep(0)
+            return 3
+
+        async def change(new_state):
+            await asyncio.sleep(0)
+            changes.append(new_state)
+
+        sensor1 = Sen(name='S 1', mqtt=mqtt, state_func=read)
+        sensor2 = Sen(name='S 2', mqtt=mqtt, state_func=read, state_topic=state)
+        sensor3 = SetSen(name='S 3', mqtt=mqtt, state_change_func=change)
+        registry.add_component([sensor1, sensor2, sensor3])
+        registry.add_shared_topic(state)
+
+        async def run():
+            registry.send_updates()
+            await registry.send_updates_async()
+            await sensor3._receive_command('3.68')
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
+
+        self.assertEqual([3.68], changes)
+        mqtt.assert_messages('homeassistant/sensor/s_1/state', ['3.00'])
+        mqtt.assert_messages('/my/topic', [{'s_2': '3.00'}])
+        mqtt.assert_messages('homeassistant/sensor/s_3/state', ['7.50', '7.50', '3.68'])